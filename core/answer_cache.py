@@ -0,0 +1,80 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from core.utils import parse_page_query, parse_chapter_query
+
+# 緩存的回答條數上限（LRU淘汰）
+ANSWER_CACHE_SIZE = 256
+# 語義命中閾值：問題向量餘弦相似度
+SEMANTIC_THRESHOLD = 0.95
+
+def normalize_question(question):
+    """問題標準化：合併空白、轉小寫（不去開頭數字，"10 個重點"與"5 個重點"是不同問題）"""
+    return " ".join(question.split()).lower()
+
+def is_targeted_query(question):
+    """指定頁碼/章節的問題（第3頁、Chapter 2）：僅數字不同的問題向量極相近，只允許精確匹配"""
+    return bool(parse_page_query(question)) or parse_chapter_query(question)[0] != ""
+
+class AnswerCache:
+    """問答結果緩存：精確匹配（文件Hash+標準化問題）+ 同一文檔內的問題向量相似匹配"""
+    def __init__(self, max_entries=ANSWER_CACHE_SIZE, similarity_threshold=SEMANTIC_THRESHOLD):
+        self.max_entries = max_entries
+        self.similarity_threshold = similarity_threshold
+        self._entries = OrderedDict()  # (file_hash, 標準化問題) -> (回答, 問題向量或None)
+        self._lock = threading.Lock()
+
+    def can_match_similar(self, file_hash, question):
+        """該問題能否走語義匹配：非指定頁碼/章節，且該文檔有緩存的回答（否則可跳過問題向量化）"""
+        if is_targeted_query(question):
+            return False
+        with self._lock:
+            return any(key[0] == file_hash for key in self._entries)
+
+    def get(self, file_hash, question):
+        """精確匹配"""
+        key = (file_hash, normalize_question(question))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def get_similar(self, file_hash, question, query_embedding):
+        """
+        語義匹配：與同一文檔已緩存問題的向量比較（向量已歸一化，點積即餘弦相似度）
+        :param question: 原始問題（指定頁碼/章節的問題不做語義匹配）
+        :param query_embedding: 歸一化的問題向量
+        :return: 相似度最高且不低於閾值的回答，否則None
+        """
+        if is_targeted_query(question):
+            return None
+        with self._lock:
+            candidates = [
+                (key, entry) for key, entry in self._entries.items()
+                if key[0] == file_hash and entry[1] is not None
+            ]
+            if not candidates:
+                return None
+            similarities = np.stack([entry[1] for _, entry in candidates]) @ np.asarray(query_embedding, dtype=np.float32)
+            best = int(np.argmax(similarities))
+            if similarities[best] < self.similarity_threshold:
+                return None
+            key, entry = candidates[best]
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def put(self, file_hash, question, answer, query_embedding=None):
+        """保存回答（可附帶問題向量供語義匹配；指定頁碼/章節的問題不保存向量，只能精確命中）"""
+        key = (file_hash, normalize_question(question))
+        embedding = None
+        if query_embedding is not None and not is_targeted_query(question):
+            embedding = np.asarray(query_embedding, dtype=np.float32)
+        with self._lock:
+            self._entries[key] = (answer, embedding)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
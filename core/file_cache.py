@@ -1,66 +1,208 @@
 import os
 import hashlib
 import json
+import mmap
 import pickle
+import threading
 from pathlib import Path
 
+try:
+    import orjson  # 可選依賴：更快的JSON編解碼
+except ImportError:
+    orjson = None
+
+try:
+    import pyarrow as pa  # 可選依賴：Arrow IPC 列式存儲，加載時內存映射
+    import pyarrow.ipc as pa_ipc
+except ImportError:
+    pa = None
+
+# 文件Hash算法與讀取緩衝區大小
+HASH_ALGO = "blake2b"
+HASH_BUFFER_SIZE = 1 << 20  # 1 MiB
+MMAP_THRESHOLD = 256 << 20  # 超過256MB的文件改用mmap一次性傳入Hash
+# 分塊緩存格式版本（舊版條目無此字段，讀取後以新格式重寫）
+CACHE_VERSION = 3
+# 索引日誌記錄數超過「有效條目數×2 + 此值」時壓縮重寫
+INDEX_COMPACT_SLACK = 32
+
+# 分塊數據的Arrow列結構（與 PDFProcessor 輸出的字段一致）
+CHUNK_SCHEMA = pa.schema([
+    ("content", pa.string()),
+    ("page", pa.int32()),
+    ("heading", pa.string()),
+    ("total_pages", pa.int32()),
+    ("author", pa.string()),
+    ("doc_title", pa.string()),
+    ("virtual_questions", pa.list_(pa.string())),
+    ("doc_language", pa.string()),
+    ("chunk_idx", pa.int32()),
+    ("total_chunks", pa.int32()),
+]) if pa is not None else None
+
+def _dump_index_line(record):
+    """序列化一條索引記錄為JSONL行（bytes，UTF-8，無縮排）"""
+    if orjson is not None:
+        return orjson.dumps(record) + b"\n"
+    return (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _load_index_line(line):
+    return orjson.loads(line) if orjson is not None else json.loads(line)
+
 class FileCacheManager:
     """文件緩存管理器：負責計算文件Hash、保存/加載處理結果"""
     def __init__(self, cache_dir="./data/cache"):
         self.cache_dir = Path(cache_dir)
         self.cache_dir.mkdir(parents=True, exist_ok=True)
-        self.index_file = self.cache_dir / "cache_index.json"
+        # 僅追加的JSONL索引：每行一條記錄，後寫入的記錄覆蓋同Hash的舊記錄
+        self.index_file = self.cache_dir / "cache_index.jsonl"
+        self.legacy_index_file = self.cache_dir / "cache_index.json"
+        self._index_records = 0
+        # Hash可能在後台線程計算（會遷移舊條目），與處理線程的保存/加載共用索引，需加鎖
+        self._lock = threading.RLock()
         self._load_index()
 
     def _load_index(self):
-        """加載緩存索引"""
+        """加載緩存索引（重放JSONL日誌；僅有舊版JSON索引時遷移）"""
+        self.cache_index = {}
         if self.index_file.exists():
-            with open(self.index_file, "r", encoding="utf-8") as f:
+            with open(self.index_file, "rb") as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    try:
+                        record = _load_index_line(line)
+                    except ValueError:
+                        continue  # 忽略寫入中斷造成的殘缺行
+                    self._index_records += 1
+                    file_hash = record.pop("hash")
+                    if record.get("deleted"):
+                        self.cache_index.pop(file_hash, None)
+                    else:
+                        self.cache_index[file_hash] = record
+        elif self.legacy_index_file.exists():
+            with open(self.legacy_index_file, "r", encoding="utf-8") as f:
                 self.cache_index = json.load(f)
-        else:
-            self.cache_index = {}
+            self._compact_index()
 
-    def _save_index(self):
-        """保存緩存索引"""
-        with open(self.index_file, "w", encoding="utf-8") as f:
-            json.dump(self.cache_index, f, ensure_ascii=False, indent=2)
+    def _append_index_record(self, file_hash, entry=None):
+        """追加一條索引記錄（entry為None表示刪除該Hash）"""
+        record = {"hash": file_hash, **entry} if entry is not None else {"hash": file_hash, "deleted": True}
+        with open(self.index_file, "ab") as f:
+            f.write(_dump_index_line(record))
+        self._index_records += 1
+        if self._index_records > len(self.cache_index) * 2 + INDEX_COMPACT_SLACK:
+            self._compact_index()
 
-    def calculate_file_hash(self, file_path):
-        """計算文件的MD5 Hash值（用于識別相同文件）"""
-        hash_md5 = hashlib.md5()
+    def _compact_index(self):
+        """壓縮索引：只保留有效條目，寫入臨時文件後原子替換"""
+        tmp_file = self.index_file.with_suffix(".jsonl.tmp")
+        with open(tmp_file, "wb") as f:
+            f.write(b"".join(
+                _dump_index_line({"hash": file_hash, **entry})
+                for file_hash, entry in self.cache_index.items()
+            ))
+        os.replace(tmp_file, self.index_file)
+        self._index_records = len(self.cache_index)
+
+    def _hash_file(self, file_path, hasher):
+        """以1MiB緩衝區流式讀取文件並更新Hash（大文件使用mmap避免用戶態拷貝）"""
         with open(file_path, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+            if os.fstat(f.fileno()).st_size > MMAP_THRESHOLD:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    hasher.update(mm)
+                return hasher.hexdigest()
+            for chunk in iter(lambda: f.read(HASH_BUFFER_SIZE), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    def calculate_file_hash(self, file_path):
+        """計算文件的BLAKE2b Hash值（用于識別相同文件），並遷移舊版MD5緩存條目"""
+        file_hash = self._hash_file(file_path, hashlib.blake2b(digest_size=16))
+        if not self.is_cached(file_hash):
+            self._migrate_legacy_entry(file_path, file_hash)
+        return file_hash
+
+    def _migrate_legacy_entry(self, file_path, file_hash):
+        """
+        舊版緩存以MD5為鍵：命中時改用新Hash作為鍵（緩存文件路徑不變）
+        舊條目只記錄了文件名，僅當文件名與某個舊條目相同時才計算MD5，其餘文件不重複讀取
+        """
+        file_name = os.path.basename(file_path)
+        with self._lock:
+            has_candidate = any(
+                "hash_algo" not in info and info.get("file_name") == file_name
+                for info in self.cache_index.values()
+            )
+        if not has_candidate:
+            return
+        legacy_hash = self._hash_file(file_path, hashlib.md5())
+        with self._lock:
+            cache_info = self.cache_index.get(legacy_hash)
+            if cache_info is None or "hash_algo" in cache_info:
+                return
+            cache_info["hash_algo"] = HASH_ALGO
+            self.cache_index[file_hash] = self.cache_index.pop(legacy_hash)
+            self._append_index_record(legacy_hash)
+            self._append_index_record(file_hash, cache_info)
 
     def is_cached(self, file_hash):
         """檢查文件是否已緩存"""
-        return file_hash in self.cache_index
+        with self._lock:
+            return file_hash in self.cache_index
 
     def save_cache(self, file_hash, file_name, chunks, vector_store_path):
         """保存處理結果到緩存"""
-        # 保存分块數據
-        chunks_file = self.cache_dir / f"{file_hash}_chunks.pkl"
-        with open(chunks_file, "wb") as f:
-            pickle.dump(chunks, f)
+        # 保存分块數據（已安裝pyarrow時使用Arrow IPC，否則pickle）
+        if pa is not None:
+            chunks_file = self.cache_dir / f"{file_hash}_chunks.arrow"
+            table = pa.Table.from_pylist(chunks, schema=CHUNK_SCHEMA)
+            with pa.OSFile(str(chunks_file), "wb") as sink:
+                with pa_ipc.new_file(sink, CHUNK_SCHEMA) as writer:
+                    writer.write_table(table)
+        else:
+            chunks_file = self.cache_dir / f"{file_hash}_chunks.pkl"
+            with open(chunks_file, "wb") as f:
+                f.write(pickle.dumps(chunks, protocol=pickle.HIGHEST_PROTOCOL))
         
-        # 更新緩存索引
-        self.cache_index[file_hash] = {
-            "file_name": file_name,
-            "chunks_path": str(chunks_file),
-            "vector_store_path": vector_store_path,
-            "timestamp": os.path.getmtime(chunks_file)
-        }
-        self._save_index()
+        with self._lock:
+            # 格式變更後刪除舊的分块文件
+            old_info = self.cache_index.get(file_hash)
+            if old_info and old_info.get("chunks_path") != str(chunks_file):
+                Path(old_info["chunks_path"]).unlink(missing_ok=True)
+            
+            # 更新緩存索引
+            self.cache_index[file_hash] = {
+                "file_name": file_name,
+                "hash_algo": HASH_ALGO,
+                "version": CACHE_VERSION,
+                "chunks_path": str(chunks_file),
+                "vector_store_path": vector_store_path,
+                "timestamp": os.path.getmtime(chunks_file)
+            }
+            self._append_index_record(file_hash, self.cache_index[file_hash])
+
+    def _read_chunks(self, chunks_path):
+        """按文件格式加載分块數據：Arrow IPC 內存映射讀取，pickle 一次性讀入再反序列化"""
+        if chunks_path.endswith(".arrow"):
+            if pa is None:
+                raise RuntimeError("讀取Arrow緩存需要安裝pyarrow")
+            with pa.memory_map(chunks_path, "r") as source:
+                return pa_ipc.open_file(source).read_all().to_pylist()
+        with open(chunks_path, "rb") as f:
+            return pickle.loads(f.read())
 
     def load_cache(self, file_hash):
         """从緩存加載處理結果"""
-        if not self.is_cached(file_hash):
+        with self._lock:
+            cache_info = self.cache_index.get(file_hash)
+        if cache_info is None:
             return None, None
         
-        cache_info = self.cache_index[file_hash]
-        # 加載分块數據
-        with open(cache_info["chunks_path"], "rb") as f:
-            chunks = pickle.load(f)
+        chunks = self._read_chunks(cache_info["chunks_path"])
+        
+        # 舊版緩存：以新格式重寫一次
+        if cache_info.get("version") != CACHE_VERSION and chunks:
+            self.save_cache(file_hash, cache_info["file_name"], chunks, cache_info["vector_store_path"])
         
         return chunks, cache_info["vector_store_path"]
\ No newline at end of file
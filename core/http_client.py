@@ -0,0 +1,24 @@
+import importlib.util
+import threading
+import httpx
+
+# DeepSeek請求共用的連接池配置
+HTTP_TIMEOUT = 60
+HTTP_LIMITS = httpx.Limits(max_connections=32, max_keepalive_connections=32)
+# HTTP/2 需要安裝 h2（httpx[http2]），未安裝時退回 HTTP/1.1 keep-alive
+HTTP2_ENABLED = importlib.util.find_spec("h2") is not None
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+def get_http_client():
+    """取得全局共享的 httpx.Client（QuestionGenerator 與 RAGEngine 共用同一連接池）"""
+    global _shared_client
+    with _shared_client_lock:
+        if _shared_client is None or _shared_client.is_closed:
+            _shared_client = httpx.Client(http2=HTTP2_ENABLED, timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS)
+        return _shared_client
+
+def create_async_http_client():
+    """新建 httpx.AsyncClient（綁定事件循環，由調用方負責關閉）"""
+    return httpx.AsyncClient(http2=HTTP2_ENABLED, timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS)
@@ -0,0 +1,72 @@
+import pdfplumber
+
+try:
+    import fitz  # PyMuPDF：可選依賴，文本提取速度遠快於pdfplumber
+except ImportError:
+    fitz = None
+
+# 頁面文本提取（PDFProcessor 與子進程共用）
+# 只依賴PDF解析庫：spawn方式啟動的子進程導入本模組時，不會連帶載入 torch / faiss / LLM 用戶端等重依賴
+
+# 已安裝PyMuPDF時優先使用；個別PDF文本順序異常時可設為False改用pdfplumber
+USE_PYMUPDF = True
+
+def open_pdf(pdf_path):
+    """打開PDF：優先PyMuPDF，否則使用pdfplumber（兩者皆支持with語句）"""
+    if USE_PYMUPDF and fitz is not None:
+        return fitz.open(pdf_path)
+    return pdfplumber.open(pdf_path)
+
+def get_pages(pdf):
+    """返回可索引的頁面序列（PyMuPDF文檔本身即可按索引取頁）"""
+    if fitz is not None and isinstance(pdf, fitz.Document):
+        return pdf
+    return pdf.pages
+
+def extract_page_sections(page):
+    """
+    單次版面分析提取頁面文本，再按行的y座標劃分頁首（上10%）與頁尾（下10%）
+    :return: (正文, 頁首, 頁尾)
+    """
+    if fitz is not None and isinstance(page, fitz.Page):
+        # 文本塊：(x0, y0, x1, y1, text, block_no, block_type)，block_type=0為文字
+        blocks = [b for b in page.get_text("blocks") if b[6] == 0]
+        header_limit = page.rect.height * 0.1
+        footer_limit = page.rect.height * 0.9
+        text = "\n".join(b[4].strip() for b in blocks)
+        header_text = "\n".join(b[4].strip() for b in blocks if b[1] < header_limit)
+        footer_text = "\n".join(b[4].strip() for b in blocks if b[3] > footer_limit)
+        return text, header_text, footer_text
+    text_lines = page.extract_text_lines()
+    header_limit = page.height * 0.1
+    footer_limit = page.height * 0.9
+    text = "\n".join(line["text"] for line in text_lines)
+    header_text = "\n".join(line["text"] for line in text_lines if line["top"] < header_limit)
+    footer_text = "\n".join(line["text"] for line in text_lines if line["bottom"] > footer_limit)
+    return text, header_text, footer_text
+
+def process_page_range(pdf_path, page_indices, page_callback=None):
+    """
+    子進程任務：獨立打開PDF，處理一段頁碼（提取文本+頁首頁尾）
+    :param pdf_path: PDF路徑
+    :param page_indices: 頁索引列表（從0開始）
+    :param page_callback: 每頁完成回調（已完成頁數），僅在本進程提取時使用
+    :return: [(page_idx, lines, page_text, body_text), ...]
+    """
+    results = []
+    with open_pdf(pdf_path) as pdf:
+        pages = get_pages(pdf)
+        for page_idx in page_indices:
+            page = pages[page_idx]
+            text, header_text, footer_text = extract_page_sections(page)
+            full_page_text = f"{header_text}\n{text}\n{footer_text}".strip()
+            if not full_page_text:
+                results.append((page_idx, [], "", text))
+                if page_callback:
+                    page_callback(len(results))
+                continue
+            lines = [line.strip() for line in full_page_text.split("\n")]
+            results.append((page_idx, lines, full_page_text, text))
+            if page_callback:
+                page_callback(len(results))
+    return results
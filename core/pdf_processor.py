@@ -1,15 +1,62 @@
-import pdfplumber
 from langchain_text_splitters import RecursiveCharacterTextSplitter
+import asyncio
+import bisect
+import os
 import re
 from core.question_generator import QuestionGenerator
+from core.utils import has_chinese
+from core.page_extractor import open_pdf, get_pages, process_page_range
 
-class PDFProcessor:
-    def __init__(self):
-        self.text_splitter = RecursiveCharacterTextSplitter(
+# 並行解析配置：每批頁數 + 最大進程數；頁數少於閾值時在本進程提取（省去啟動子進程的開銷）
+PAGE_BATCH_SIZE = 10
+MAX_PAGE_WORKERS = min(os.cpu_count() or 1, 6)
+PARALLEL_MIN_PAGES = 50
+
+_page_pool = None
+
+def _get_page_pool():
+    """全局共享的頁面提取進程池（首次需要時創建，跨PDF重用，避免每次上傳重新啟動子進程）"""
+    global _page_pool
+    if _page_pool is None:
+        # 延遲導入：避免模組載入時建立進程池相關資源
+        from concurrent.futures import ProcessPoolExecutor
+        _page_pool = ProcessPoolExecutor(max_workers=MAX_PAGE_WORKERS)
+    return _page_pool
+
+# 預編譯正則（元信息/語言/標題識別）
+_AUTHOR_RE = re.compile(r'(作者|编者|主编|著者|Author|Editor|Writer)\s*[:：]\s*([^\n]+)', re.I)
+_TITLE_RE = re.compile(r'^([^\n]{1,50})$')
+# 標題特徵合併為單一交替正則：Chapter X / Section X / 第X章 / 1.2 編號 / Markdown #
+_HEADING_RE = re.compile(
+    r'^(?:'
+    r'(?P<chap>[Cc]hapter\s*[0-9]+(?:\.[0-9]+)*)'
+    r'|(?P<sec>[Ss]ection\s*[0-9]+(?:\.[0-9]+)*)'
+    r'|(?P<cn>第[一二三四五六七八九十0-9]+[章节条节])'
+    r'|(?P<num>[0-9]+\.[0-9.]+)'
+    r'|(?P<md>#)'
+    r')'
+)
+
+# 頁面拼接分隔符（與拆分器首選分隔符一致）
+PAGE_SEPARATOR = "\n\n"
+
+_text_splitter = None
+
+def _get_text_splitter():
+    """全局共享的文本拆分器（只構建一次，跨PDF重用）"""
+    global _text_splitter
+    if _text_splitter is None:
+        _text_splitter = RecursiveCharacterTextSplitter(
             chunk_size=500,          
             chunk_overlap=200,       
-            separators=["\n\n", "\n", "。", "！", "？", ".", "!", "?", " ", ""]  # 双语分隔符
+            separators=["\n\n", "\n", "。", "！", "？", ".", "!", "?", " ", ""],  # 双语分隔符
+            add_start_index=True  # 記錄區塊在全文中的起始位置，用於映射回頁碼
         )
+    return _text_splitter
+
+class PDFProcessor:
+    def __init__(self):
+        self.text_splitter = _get_text_splitter()
         self.meta_keywords = ["作者", "編者", "主編", "著者", "Author", "Editor", "Writer"]
         self.question_generator = QuestionGenerator()
         self.processed_chunks = []  
@@ -17,15 +64,15 @@ class PDFProcessor:
             "Abstract", "Introduction", "Conclusion", "Summary", 
             "Preface", "Appendix", "Method", "Result", "Discussion"
         ]
+        self._en_fixed_headings_lower = frozenset(h.lower() for h in self.en_fixed_headings)
+        self._meta_keywords_re = re.compile("|".join(map(re.escape, self.meta_keywords)))
 
     def extract_meta_info(self, text):
         meta_info = {}
-        author_pattern = r'(作者|编者|主编|著者|Author|Editor|Writer)\s*[:：]\s*([^\n]+)'
-        author_match = re.search(author_pattern, text, re.I)
+        author_match = _AUTHOR_RE.search(text)
         if author_match:
             meta_info["author"] = author_match.group(2).strip()
-        title_pattern = r'^([^\n]{1,50})$'
-        title_match = re.search(title_pattern, text)
+        title_match = _TITLE_RE.search(text)
         if title_match and len(title_match.group(1).strip()) > 2:
             meta_info["title"] = title_match.group(1).strip()
         return meta_info
@@ -37,102 +84,111 @@ class PDFProcessor:
         :param text: 待檢測文本
         :return: "zh"（中文）/ "en"（英文）
         """
-        chinese_char_pattern = r'[\u4e00-\u9fff]'
-        if re.search(chinese_char_pattern, text):
+        if has_chinese(text):
             return "zh"
         return "en"
 
-    def load_pdf_with_pages(self, pdf_path, progress_callback=None):
+    def load_pdf_with_pages(self, pdf_path, progress_callback=None, chunk_callback=None):
+        """
+        解析PDF並生成帶虛擬問題的文本塊
+        :param progress_callback: 進度回調 (進度, 步驟名)
+        :param chunk_callback: 文本塊完成回調（[文本塊]），虛擬問題生成期間即可下游處理（如提前向量化）
+        :return: 文本塊列表
+        """
         temp_chunks = []
         current_heading = "未分類章節 / Unclassified Chapter"
         doc_meta = {}  
         doc_language = "en"
 
         try:
-            with pdfplumber.open(pdf_path) as pdf:
-                total_pages = len(pdf.pages)
-                # 第一步：提取元信息+檢測文檔主語言
-                full_doc_text = ""
-                if progress_callback:
-                    progress_callback(0.05, f"提取文檔元信息（前{min(5, total_pages)}頁）")
-                for page_idx in range(min(5, total_pages)):
-                    page = pdf.pages[page_idx]
-                    text = page.extract_text() or ""
-                    full_doc_text += text + "\n"
-                    page_meta = self.extract_meta_info(text)
-                    doc_meta.update(page_meta)
-                    if doc_meta.get("author") and doc_meta.get("title"):
-                        break
-                doc_language = self.detect_language(full_doc_text)
-
-                # 第二步：逐頁處理文本（細化進度）
-                total_process_steps = total_pages * 4  # 每頁4个核心步骤
-                completed_steps = 0
-                
+            with open_pdf(pdf_path) as pdf:
+                total_pages = len(get_pages(pdf))
+
+            # 第一步：多進程並行提取頁面文本（按批次分發，保持原頁序）
+            if progress_callback:
+                progress_callback(0.1, f"開始並行處理（共{total_pages}頁）")
+            page_results = self._extract_pages_parallel(pdf_path, total_pages, progress_callback)
+
+            # 第二步：從已提取的前5頁正文取元信息+檢測文檔主語言（無需重複提取）
+            meta_texts = []
+            for _, _, _, body_text in page_results[:5]:
+                meta_texts.append(body_text)
+                doc_meta.update(self.extract_meta_info(body_text))
+                if doc_meta.get("author") and doc_meta.get("title"):
+                    break
+            doc_language = self.detect_language("\n".join(meta_texts))
+
+            # 第三步：順序識別章節標題（跨頁狀態），並拼接全文記錄各頁起始位置
+            page_texts = []
+            page_offsets = []  # 各頁在全文中的起始偏移
+            page_info = []  # (頁碼, 該頁結束時的章節標題)
+            offset = 0
+            for page_idx, lines, full_page_text, _ in page_results:
+                if not full_page_text:
+                    continue
+                for clean_line in lines:
+                    if self.is_heading(clean_line):
+                        current_heading = clean_line
+                page_offsets.append(offset)
+                page_info.append((page_idx + 1, current_heading))
+                page_texts.append(full_page_text)
+                offset += len(full_page_text) + len(PAGE_SEPARATOR)
+
+            # 全文只拆分一次，按區塊起始位置映射回頁碼/章節
+            if progress_callback:
+                progress_callback(0.4, "拆分全文為文本區塊")
+            documents = self.text_splitter.create_documents([PAGE_SEPARATOR.join(page_texts)]) if page_texts else []
+            pending_chunks = []
+            for doc in documents:
+                page_pos = max(0, bisect.bisect_right(page_offsets, doc.metadata.get("start_index", 0)) - 1)
+                page_num, heading = page_info[page_pos]
+                meta_info = {
+                    "doc_title": doc_meta.get("title", "未找到 / Not Found"),
+                    "heading": heading,
+                    "page": page_num,
+                    "author": doc_meta.get("author", "未找到 / Not Found"),
+                    "doc_language": doc_language
+                }
+                pending_chunks.append((doc.page_content, meta_info))
+
+            # 第四步：並發批量產生虛擬問題並增強內容
+            if progress_callback:
+                progress_callback(0.4, f"為{len(pending_chunks)}個文本區塊生成虛擬問題")
+
+            def on_questions_progress(completed, total):
                 if progress_callback:
-                    progress_callback(0.1, f"開始逐頁處理（共{total_pages}頁）")
-                
-                for page_idx, page in enumerate(pdf.pages):
-                    page_num = page_idx + 1
-                    
-                    # 2.1 提取頁面文本
-                    if progress_callback:
-                        progress = 0.1 + (completed_steps / total_process_steps) * 0.75
-                        progress_callback(progress, f"提取第{page_num}頁文本")
-                    text = page.extract_text() or ""
-                    header_text = page.crop((0, 0, page.width, page.height*0.1)).extract_text() or ""
-                    footer_text = page.crop((0, page.height*0.9, page.width, page.height)).extract_text() or ""
-                    full_page_text = f"{header_text}\n{text}\n{footer_text}".strip()
-                    completed_steps += 1
-                    if not full_page_text:
-                        continue
-                    
-                    # 2.2 標題識別
-                    if progress_callback:
-                        progress = 0.1 + (completed_steps / total_process_steps) * 0.75
-                        progress_callback(progress, f"識別第{page_num}頁章節標題")
-                    lines = full_page_text.split("\n")
-                    for line in lines:
-                        clean_line = line.strip()
-                        if self.is_heading(clean_line):
-                            current_heading = clean_line
-                    completed_steps += 1
-                    
-                    # 2.3 文本分區塊
-                    if progress_callback:
-                        progress = 0.1 + (completed_steps / total_process_steps) * 0.75
-                        progress_callback(progress, f"拆分第{page_num}頁文本为區塊")
-                    chunks = self.text_splitter.split_text(full_page_text)
-                    completed_steps += 1
-                    
-                    # 2.4 產生虛擬問題並增強內容
-                    for c in chunks:
-                        if progress_callback:
-                            progress = 0.1 + (completed_steps / total_process_steps) * 0.75
-                            progress_callback(progress, f"為第{page_num}頁文本區塊生成虛擬問題")
-                        meta_info = {
-                            "doc_title": doc_meta.get("title", "未找到 / Not Found"),
-                            "heading": current_heading,
-                            "page": page_num,
-                            "author": doc_meta.get("author", "未找到 / Not Found"),
-                            "doc_language": doc_language
-                        }
-                        virtual_questions = self.question_generator.generate_virtual_questions(c, meta_info)
-                        enhanced_content = f"{c}\n【虛擬檢索問題 / Virtual Query】：{' | '.join(virtual_questions)}"
-                        chunk_meta = {
-                            "content": enhanced_content,
-                            "page": page_num,
-                            "heading": current_heading,
-                            "total_pages": total_pages,
-                            "author": doc_meta.get("author", "未找到 / Not Found"),
-                            "doc_title": doc_meta.get("title", "未找到 / Not Found"),
-                            "virtual_questions": virtual_questions,
-                            "doc_language": doc_language,
-                            "chunk_idx": 0,
-                            "total_chunks": 0
-                        }
-                        temp_chunks.append(chunk_meta)
-                        completed_steps += 1
+                    progress = 0.4 + (completed / total) * 0.45
+                    progress_callback(progress, f"已生成虛擬問題（{completed}/{total}）")
+
+            # 每塊虛擬問題生成後立即組裝（按原序號落位），並交給下游
+            temp_chunks = [None] * len(pending_chunks)
+
+            def on_chunk_ready(index, virtual_questions):
+                c, meta_info = pending_chunks[index]
+                enhanced_content = f"{c}\n【虛擬檢索問題 / Virtual Query】：{' | '.join(virtual_questions)}"
+                chunk_meta = {
+                    "content": enhanced_content,
+                    "page": meta_info["page"],
+                    "heading": meta_info["heading"],
+                    "total_pages": total_pages,
+                    "author": meta_info["author"],
+                    "doc_title": meta_info["doc_title"],
+                    "virtual_questions": virtual_questions,
+                    "doc_language": doc_language,
+                    "chunk_idx": 0,
+                    "total_chunks": 0
+                }
+                temp_chunks[index] = chunk_meta
+                if chunk_callback:
+                    chunk_callback([chunk_meta])
+
+            asyncio.run(
+                self.question_generator.generate_virtual_questions_batch(
+                    pending_chunks,
+                    progress_callback=on_questions_progress,
+                    result_callback=on_chunk_ready
+                )
+            )
             
             # 全局索引賦值
             total_chunks = len(temp_chunks)
@@ -153,26 +209,57 @@ class PDFProcessor:
             self.processed_chunks = []
             return []
 
+    def _extract_pages_parallel(self, pdf_path, total_pages, progress_callback=None):
+        """
+        將頁面按批次分發到進程池，每個子進程獨立打開PDF處理一段頁碼
+        子進程只執行 core.page_extractor 的函數（僅依賴PDF解析庫）
+        :return: 按原頁序排列的 [(page_idx, lines, page_text, body_text), ...]
+        """
+        if total_pages < PARALLEL_MIN_PAGES:
+            # 頁數少時無需進程池：一次打開PDF提取全部頁面
+            return self._extract_pages_inline(pdf_path, total_pages, progress_callback)
+
+        batches = [
+            list(range(start, min(start + PAGE_BATCH_SIZE, total_pages)))
+            for start in range(0, total_pages, PAGE_BATCH_SIZE)
+        ]
+        page_results = []
+        from concurrent.futures.process import BrokenProcessPool
+        global _page_pool
+        pool = _get_page_pool()
+        try:
+            # executor.map 保持提交順序
+            results = pool.map(process_page_range, [pdf_path] * len(batches), batches)
+            for batch_idx, batch_result in enumerate(results):
+                page_results.extend(batch_result)
+                if progress_callback:
+                    progress = 0.1 + ((batch_idx + 1) / len(batches)) * 0.3
+                    progress_callback(progress, f"已提取{len(page_results)}/{total_pages}頁文本")
+        except BrokenProcessPool:
+            # 子進程異常退出後進程池不可再用：關閉並丟棄，在本進程重新提取
+            pool.shutdown(wait=False, cancel_futures=True)
+            if _page_pool is pool:
+                _page_pool = None
+            page_results = self._extract_pages_inline(pdf_path, total_pages, progress_callback)
+        return page_results
+
+    def _extract_pages_inline(self, pdf_path, total_pages, progress_callback=None):
+        """在本進程一次打開PDF提取全部頁面，逐頁報告進度"""
+        on_page = None
+        if progress_callback:
+            def on_page(done):
+                progress_callback(0.1 + (done / total_pages) * 0.3, f"已提取{done}/{total_pages}頁文本")
+        return process_page_range(pdf_path, range(total_pages), on_page)
+
     def is_heading(self, line):
         clean_line = line.strip()
         if len(clean_line) < 2 or len(clean_line) > 200:
             return False
-        if any(kw in clean_line for kw in self.meta_keywords):
+        if self._meta_keywords_re.search(clean_line):
             return False
-        line_lower = clean_line.lower()
-        line_upper = clean_line.upper()
-
-        if any(h.lower() == line_lower or h.upper() == line_upper for h in self.en_fixed_headings):
-            return True
-        if re.match(r'^[Cc]hapter\s*[0-9]+(\.[0-9]+)*', clean_line):
-            return True
-        if re.match(r'^[Ss]ection\s*[0-9]+(\.[0-9]+)*', clean_line):
-            return True
-        if re.match(r'^第[一二三四五六七八九十0-9]+[章节条节]', clean_line):
-            return True
-        if re.match(r'^[0-9]+\.[0-9\.]+[\s\-\_]*.*', clean_line):
+        if clean_line.lower() in self._en_fixed_headings_lower:
             return True
-        if clean_line.startswith(("#", "##", "###", "####")):
+        if _HEADING_RE.match(clean_line):
             return True
         if clean_line.isupper() and len(clean_line.split()) <= 10:
             return True
@@ -1,22 +1,56 @@
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 from dotenv import load_dotenv
+import asyncio
 import os
-import re
+from core.http_client import get_http_client, create_async_http_client
+from core.utils import has_chinese
 
 # 載入配置
 load_dotenv()
 
+# 批量生成時的最大並發請求數
+MAX_CONCURRENT_REQUESTS = 16
+
 class QuestionGenerator:
     def __init__(self):
         self.base_url = "https://api.deepseek.com"
+        self._client_cache = {}
     
     def _get_client(self):
-        """動態取得 OpenAI 用戶端（每次都讀最新的 API Key）"""
-        return OpenAI(
+        """取得 OpenAI 用戶端（按 API Key 緩存，Key 變更時才重建，保留連接池）"""
+        key = (os.getenv("DEEPSEEK_API_KEY"), self.base_url)
+        if key not in self._client_cache:
+            self._client_cache.clear()
+            self._client_cache[key] = OpenAI(api_key=key[0], base_url=key[1], http_client=get_http_client())
+        return self._client_cache[key]
+
+    def _get_async_client(self):
+        """取得 AsyncOpenAI 用戶端（綁定事件循環，每批次新建，用完關閉）"""
+        return AsyncOpenAI(
             api_key=os.getenv("DEEPSEEK_API_KEY"),
-            base_url=self.base_url
+            base_url=self.base_url,
+            http_client=create_async_http_client()
         )
 
+    def _build_prompt(self, text_chunk, meta_info, num_questions):
+        """依文本語言構建生成虛擬問題的Prompt"""
+        # 識別文本語言：含中文則生成中文問題，否則生成英文問題
+        if has_chinese(text_chunk):
+            return f"""你是專業的文檔問答優化助手，請基於以下文字內容，產生{num_questions}個符合用戶提問習慣的中文虛擬問題：
+    1. 問題需涵蓋文字核心訊息；2. 簡潔易懂，符合日常提問邏輯；3. 每個問題獨立成行，僅傳回問題清單。
+    【文本内容】：{text_chunk}
+    【元信息】：文檔標題：{meta_info.get('doc_title', '未知')}，章節：{meta_info.get('heading', '未知')}，頁碼：第{meta_info.get('page', '未知')}頁"""
+        return f"""You are a professional document Q&A assistant. Generate {num_questions} natural English virtual questions based on the text below:
+    1. Cover the core information of the text; 2. Simple and in line with daily query habits; 3. Return only the question list, one question per line.
+    【Text Content】：{text_chunk}
+    【Meta Info】：Title: {meta_info.get('doc_title', 'Unknown')}, Chapter: {meta_info.get('heading', 'Unknown')}, Page: {meta_info.get('page', 'Unknown')}"""
+
+    def _parse_questions(self, content, num_questions):
+        """解析模型回覆為問題列表"""
+        questions = content.strip().split("\n")
+        valid_questions = [q.strip() for q in questions if q.strip() and len(q.strip()) > 5]
+        return valid_questions[:num_questions]
+
     def generate_virtual_questions(self, text_chunk, meta_info, num_questions=8):
         """
         基於文本塊生成虛擬問題（作为檢索入口）
@@ -27,18 +61,7 @@ class QuestionGenerator:
         """
         if len(text_chunk.strip()) < 20:
             return []
-        # 識別文本語言：含中文則生成中文問題，否則生成英文問題
-        has_chinese = bool(re.search(r'[\u4e00-\u9fff]', text_chunk))
-        if has_chinese:
-            prompt = f"""你是專業的文檔問答優化助手，請基於以下文字內容，產生{num_questions}個符合用戶提問習慣的中文虛擬問題：
-    1. 問題需涵蓋文字核心訊息；2. 簡潔易懂，符合日常提問邏輯；3. 每個問題獨立成行，僅傳回問題清單。
-    【文本内容】：{text_chunk}
-    【元信息】：文檔標題：{meta_info.get('doc_title', '未知')}，章節：{meta_info.get('heading', '未知')}，頁碼：第{meta_info.get('page', '未知')}頁"""
-        else:
-            prompt = f"""You are a professional document Q&A assistant. Generate {num_questions} natural English virtual questions based on the text below:
-    1. Cover the core information of the text; 2. Simple and in line with daily query habits; 3. Return only the question list, one question per line.
-    【Text Content】：{text_chunk}
-    【Meta Info】：Title: {meta_info.get('doc_title', 'Unknown')}, Chapter: {meta_info.get('heading', 'Unknown')}, Page: {meta_info.get('page', 'Unknown')}"""
+        prompt = self._build_prompt(text_chunk, meta_info, num_questions)
         try:
             client = self._get_client()
             response = client.chat.completions.create(
@@ -47,9 +70,57 @@ class QuestionGenerator:
                 temperature=0.7,
                 max_tokens=2000
             )
-            questions = response.choices[0].message.content.strip().split("\n")
-            valid_questions = [q.strip() for q in questions if q.strip() and len(q.strip()) > 5]
-            return valid_questions[:num_questions]
+            return self._parse_questions(response.choices[0].message.content, num_questions)
         except Exception as e:
             print(f"產生虛擬問題失敗 / Generate Virtual Questions Error: {e}")
-            return []
\ No newline at end of file
+            return []
+
+    async def generate_virtual_questions_batch(self, chunks_with_meta, num_questions=8, progress_callback=None,
+                                               result_callback=None):
+        """
+        並發批量生成虛擬問題（信號量限制並發數）
+        :param chunks_with_meta: [(text_chunk, meta_info), ...]
+        :param num_questions: 每個文本塊生成虛擬問題數量
+        :param progress_callback: 進度回調 (已完成數, 總數)
+        :param result_callback: 單塊完成回調 (輸入序號, 虛擬問題列表)，按完成順序調用
+        :return: 與輸入順序一致的虛擬問題列表的列表
+        """
+        if not chunks_with_meta:
+            return []
+        client = self._get_async_client()
+        semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+        total = len(chunks_with_meta)
+        completed = 0
+
+        async def generate_one(index, text_chunk, meta_info):
+            nonlocal completed
+            questions = []
+            try:
+                if len(text_chunk.strip()) < 20:
+                    return questions
+                prompt = self._build_prompt(text_chunk, meta_info, num_questions)
+                async with semaphore:
+                    response = await client.chat.completions.create(
+                        model="deepseek-chat",
+                        messages=[{"role": "user", "content": prompt}],
+                        temperature=0.7,
+                        max_tokens=2000
+                    )
+                questions = self._parse_questions(response.choices[0].message.content, num_questions)
+                return questions
+            except Exception as e:
+                print(f"產生虛擬問題失敗 / Generate Virtual Questions Error: {e}")
+                return questions
+            finally:
+                completed += 1
+                if result_callback:
+                    result_callback(index, questions)
+                if progress_callback:
+                    progress_callback(completed, total)
+
+        try:
+            return await asyncio.gather(
+                *(generate_one(i, text_chunk, meta_info) for i, (text_chunk, meta_info) in enumerate(chunks_with_meta))
+            )
+        finally:
+            await client.close()
@@ -1,4 +1,34 @@
 import re
+from functools import lru_cache
+
+# 預編譯正則（頁碼/章節/句子解析）
+_EN_RANGE_RE = re.compile(r'page(s)?(\d+)[:\-to](\d+)')
+_EN_SINGLE_RE = re.compile(r'page(\d+)|(\d+)thpage')
+_CN_RANGE_RE = re.compile(r'第?(\d+)[:\-到至](\d+)頁')
+_CN_SINGLE_RE = re.compile(r'第?(\d+)頁')
+_LAST_SENT_KEYWORDS = [
+    "最後一句", "最後一句話", "finalsentence", 
+    "lastsentence", "thelastline", "lastline"
+]
+_LAST_SENT_RE = re.compile("|".join(map(re.escape, _LAST_SENT_KEYWORDS)))
+_EN_CHAPTER_RE = re.compile(r'(chapter|section)(\d+)')  # Chapter1/section3
+_EN_FIXED_HEADING_RE = re.compile(r'(abstract|introduction|conclusion|summary|preface|appendix)')  # 英文固定章節名
+_CN_CHAPTER_RE = re.compile(r'(第\d+[章節條節])|(第[一二三四五六七八九十百]+[章節條節])')
+_WHITESPACE_RE = re.compile(r'\s+')
+# 雙語句末標點：中文+英文
+_SENTENCE_TERMINALS = "。！？.?!"
+_CHINESE_CHAR_RE = re.compile(r'[\u4e00-\u9fff]')
+# 虛擬問題開頭的序號：1. / (2) / 【三】 / 四、
+_SERIAL_RE = re.compile(r'^\s*[(【[]?(\d+|[一二三四五六七八九十百千]+)[.、)\]\s]\s*')
+
+def has_chinese(text):
+    """
+    判斷文本是否包含中文漢字
+    純ASCII文本（英文文檔常見）由 str.isascii() 直接短路，否則使用預編譯正則
+    """
+    if not text or text.isascii():
+        return False
+    return _CHINESE_CHAR_RE.search(text) is not None
 
 def parse_page_query(question):
     """
@@ -10,22 +40,17 @@ def parse_page_query(question):
     """
     question = question.replace(" ", "").lower()  # 統一小寫+去空格，兼容大小寫
     # 英文匹配：pageX、pagesX-Y、pageXtoY、Xthpage
-    en_range_pattern = r'page(s)?(\d+)[:\-to](\d+)'
-    en_single_pattern = r'page(\d+)|(\d+)thpage'
     # 中文匹配：第X頁、X頁、X-Y頁、X到Y頁
-    cn_range_pattern = r'第?(\d+)[:\-到至](\d+)頁'
-    cn_single_pattern = r'第?(\d+)頁'
-
     page_nums = []
     # 優先匹配連續頁碼（英→中）
-    en_range_match = re.search(en_range_pattern, question)
+    en_range_match = _EN_RANGE_RE.search(question)
     if en_range_match:
         start = int(en_range_match.group(2))
         end = int(en_range_match.group(3))
         if start <= end:
             page_nums = list(range(start, end + 1))
         return page_nums
-    cn_range_match = re.search(cn_range_pattern, question)
+    cn_range_match = _CN_RANGE_RE.search(question)
     if cn_range_match:
         start = int(cn_range_match.group(1))
         end = int(cn_range_match.group(2))
@@ -33,12 +58,12 @@ def parse_page_query(question):
             page_nums = list(range(start, end + 1))
         return page_nums
     # 匹配單頁碼（英→中）
-    en_single_match = re.search(en_single_pattern, question)
+    en_single_match = _EN_SINGLE_RE.search(question)
     if en_single_match:
         num = en_single_match.group(1) or en_single_match.group(2)
         page_nums = [int(num)]
         return page_nums
-    cn_single_match = re.search(cn_single_pattern, question)
+    cn_single_match = _CN_SINGLE_RE.search(question)
     if cn_single_match:
         page_nums = [int(cn_single_match.group(1))]
     return page_nums
@@ -53,31 +78,24 @@ def parse_chapter_query(question):
     """
     question = question.replace(" ", "").lower()
     # 【最後一句】雙語關鍵詞匹配
-    last_sent_keywords = [
-        "最後一句", "最後一句話", "finalsentence", 
-        "lastsentence", "thelastline", "lastline"
-    ]
-    is_last_sent = any(kw in question for kw in last_sent_keywords)
+    is_last_sent = _LAST_SENT_RE.search(question) is not None
 
     # 【英文章節】匹配：chapterX、sectionX、abstract、introduction等固定標題
-    en_chapter_pattern = r'(chapter|section)(\d+)'  # Chapter1/section3
-    en_fixed_heading = r'(abstract|introduction|conclusion|summary|preface|appendix)'  # 英文固定章節名
     # 【中文章節】匹配：第X章、第X節、第二章
-    cn_chapter_pattern = r'(第\d+[章節條節])|(第[一二三四五六七八九十百]+[章節條節])'
 
     chapter_name = ""
     # 1. 匹配英文固定章節名（Abstract/Introduction等，優先返回原大小寫）
-    en_fixed_match = re.search(en_fixed_heading, question)
+    en_fixed_match = _EN_FIXED_HEADING_RE.search(question)
     if en_fixed_match:
         chapter_name = en_fixed_match.group(1).capitalize()  # 統一首字母大寫（Abstract/Introduction）
     # 2. 匹配英文數字章節（Chapter1→Chapter 1）
-    en_num_match = re.search(en_chapter_pattern, question)
+    en_num_match = _EN_CHAPTER_RE.search(question)
     if not chapter_name and en_num_match:
         type_ = en_num_match.group(1).capitalize()  # Chapter/Section
         num = en_num_match.group(2)
         chapter_name = f"{type_} {num}"
     # 3. 匹配中文章節
-    cn_num_match = re.search(cn_chapter_pattern, question)
+    cn_num_match = _CN_CHAPTER_RE.search(question)
     if not chapter_name and cn_num_match:
         chapter_name = cn_num_match.group(1) or cn_num_match.group(2)
 
@@ -93,23 +111,22 @@ def extract_last_sentence(text):
         return "未找到有效句子 / No valid sentence found"
     # 清理幹擾内容（虛擬問題標記、多餘空格）
     text = text.replace("【虛擬检索問題】：", "").strip()
-    text = re.sub(r'\s+', ' ', text)  # 多个空格合并為一个，适配英文
+    text = _WHITESPACE_RE.sub(' ', text)  # 多个空格合并為一个，适配英文
 
-    # 雙語分割符：中文+英文結束標點，保留標點
-    bilingual_separators = r'([。！？.?!])'
-    parts = re.split(bilingual_separators, text)
-    # 重組完整句子（内容+標點）
-    sentences = []
-    for i in range(0, len(parts)-1, 2):
-        content = parts[i].strip()
-        symbol = parts[i+1]
-        if content and symbol in ["。", "！", "？", ".", "?", "!"]:
-            sentences.append(f"{content}{symbol}")
-    # 處理最後一段無標點的情况（視為完整句子）
-    if len(parts) % 2 != 0 and parts[-1].strip():
-        sentences.append(parts[-1].strip())
+    # 最後一段無標點的情况（視為完整句子）
+    last = max(text.rfind(symbol) for symbol in _SENTENCE_TERMINALS)
+    tail = text[last + 1:].strip()
+    if tail:
+        return tail
+    # 從末尾向前找到第一个非空的「内容+標點」句子（rfind快速路徑，無需拆分全文）
+    while last != -1:
+        prev = max(text.rfind(symbol, 0, last) for symbol in _SENTENCE_TERMINALS)
+        content = text[prev + 1:last].strip()
+        if content:
+            return f"{content}{text[last]}"
+        last = prev
     # 無有效句子時返回雙語提示
-    return sentences[-1] if sentences else "未找到有效句子 / No valid sentence found"
+    return "未找到有效句子 / No valid sentence found"
 
 def is_special_query(question):
     """
@@ -120,4 +137,23 @@ def is_special_query(question):
     chapter_name, is_last_sent = parse_chapter_query(question)
     is_page = len(page_nums) > 0
     is_chapter_last = chapter_name != "" and is_last_sent
-    return is_page, is_chapter_last, page_nums, chapter_name
\ No newline at end of file
+    return is_page, is_chapter_last, page_nums, chapter_name
+
+@lru_cache(maxsize=8192)
+def clean_question_serial_number(question: str) -> str:
+    """去除問題開頭的序號（純函數，結果按字符串緩存）"""
+    if not question:
+        return question
+    return _SERIAL_RE.sub('', question.strip()).strip()
+
+def collect_virtual_questions(chunks):
+    """
+    彙總所有文本塊的虛擬問題：去空白、清洗序號、過濾過短問題並去重
+    :param chunks: 文本塊列表（含 virtual_questions 字段）
+    :return: 去重後的問題列表（保持首次出現順序）
+    """
+    clean = clean_question_serial_number
+    questions = (q.strip() for chunk in chunks for q in (chunk.get("virtual_questions") or []) if q)
+    cleaned = (clean(q) for q in questions if len(q) > 5)
+    # dict.fromkeys 單次遍歷即可有序去重
+    return [q for q in dict.fromkeys(cleaned) if len(q) > 5]
@@ -1,56 +1,358 @@
+import os
+
+# 線程配置：Torch（向量化/重排）與FAISS（OpenMP）共用CPU，各限一半核心避免超額訂閱
+# 須在載入faiss/torch之前設定環境變量；已由用戶設定時保持不變
+TORCH_NUM_THREADS = max(1, (os.cpu_count() or 2) // 2)
+os.environ.setdefault("OMP_NUM_THREADS", str(TORCH_NUM_THREADS))
+os.environ.setdefault("MKL_NUM_THREADS", str(TORCH_NUM_THREADS))
+os.environ.setdefault("KMP_AFFINITY", "granularity=fine,compact")
+
 from langchain_community.vectorstores import FAISS
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores.utils import DistanceStrategy
+import faiss
+from langchain_core.documents import Document
 from langchain_core.embeddings import Embeddings
-import os
 import hashlib
 import json
+import pickle
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from sentence_transformers import SentenceTransformer, CrossEncoder
 import numpy as np
 import re
-from collections import defaultdict
+from collections import OrderedDict, defaultdict, deque
+from functools import cached_property
+from itertools import groupby
+from operator import itemgetter
 from core.utils import is_special_query, parse_page_query, parse_chapter_query
 
+try:
+    import onnxruntime as ort  # 可選依賴：ONNX Runtime 執行重排模型
+    from transformers import AutoTokenizer
+except ImportError:
+    ort = None
+
+try:
+    from numba import njit  # 可選依賴：JIT編譯得分融合，未安裝時以NumPy執行
+except ImportError:
+    njit = None
+
+# 預編譯正則：查詢關鍵詞 / 英文名字（「名+姓」）
+_WORD_RE = re.compile(r'\w+')
+_NAME_RE = re.compile(r'[A-Z][a-z]+\s+[A-Z][a-z]+')
+
+# 文檔向量化批大小（SentenceTransformer.encode 內部已按長度排序分批，減少padding）
+EMBED_BATCH_SIZE = 64
+
+# 增量向量化隊列上限（解析/虛擬問題生成與向量化重疊，隊列滿時轉入溢出緩衝，生產端不阻塞）
+INCREMENTAL_QUEUE_SIZE = 64
+
+# 重排模型；已導出ONNX文件時優先用ONNX Runtime推理，否則使用CrossEncoder
+# 導出：optimum-cli export onnx --model cross-encoder/ms-marco-TinyBERT-L-2-v2 ./models/ms-marco-TinyBERT-L-2-v2
+RERANKER_MODEL = "cross-encoder/ms-marco-TinyBERT-L-2-v2"
+RERANKER_ONNX_PATH = "./models/ms-marco-TinyBERT-L-2-v2/model.onnx"
+RERANKER_MAX_LENGTH = 512
+
+# 重排得分緩存上限（按 (查詢Hash, 内容Hash) 記錄，LRU淘汰）
+RERANK_CACHE_SIZE = 10_000
+
+# 塊數達到此值時全局索引改用HNSW圖索引（次線性檢索）；分片檢索仍在其原始向量上精確計算
+HNSW_MIN_ROWS = 50_000
+HNSW_M = 32
+HNSW_EF_CONSTRUCTION = 200
+HNSW_EF_SEARCH = 64
+
+# 全局索引使用8位標量量化（向量已歸一化，內積排序與L2一致）；設為False則使用float32內積平面索引（IndexFlatIP）
+QUANTIZE_INDEX = True
+
+# 索引目錄（位於保存路徑下，整體替換）及其文件：FAISS索引 + 行號對齊的文檔 + 分片行號範圍
+INDEX_DIR = "current"
+INDEX_FILE = "global.faiss"
+DOCUMENTS_FILE = "documents.pkl"
+SHARD_MAP_FILE = "shard_map.json"
+
+# 分片並行檢索線程池（FAISS檢索釋放GIL，可真正並行）
+_SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="faiss-search")
+
+# 已載入模型的進程內緩存（按模型名共享，多個實例不重複載入）
+_MODEL_CACHE = {}
+_MODEL_CACHE_LOCK = threading.Lock()
+
+def _get_cached_model(key, loader):
+    """首次使用時載入模型並緩存"""
+    with _MODEL_CACHE_LOCK:
+        if key not in _MODEL_CACHE:
+            _MODEL_CACHE[key] = loader()
+        return _MODEL_CACHE[key]
+
+_torch_threads_configured = False
+
+def _configure_torch_threads():
+    """設定Torch運算線程數（進程內只設定一次；inter-op線程池須在首次並行運算前設定）"""
+    global _torch_threads_configured
+    if _torch_threads_configured:
+        return
+    _torch_threads_configured = True
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(TORCH_NUM_THREADS)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:
+        pass  # 已有並行運算執行過，無法再修改
+
+def _fuse_scores(weighted, rerank, pc_weight):
+    """
+    融合加權得分與reranker得分（各自標準化到0-1）
+    :param weighted: 加權得分數組
+    :param rerank: reranker得分數組
+    :param pc_weight: 頁碼/章節權重（加權得分按 pc_weight*2 標準化）
+    """
+    norm_weighted = weighted / (pc_weight * 2)
+    rmin = rerank.min()
+    norm_rerank = (rerank - rmin) / (rerank.max() - rmin + 1e-6)
+    return 0.6 * norm_weighted + 0.4 * norm_rerank  # 加權得分占60%，reranker占40%
+
+if njit is not None:
+    _fuse_scores = njit(cache=True)(_fuse_scores)
+
+def _topk_indices(scores, k):
+    """
+    返回得分最高的k個下標（降序，同分按原順序）：先部分選擇出前k個，再只對k個候選排序
+    """
+    n = len(scores)
+    if k >= n:
+        return np.argsort(-scores, kind="stable")
+    if k <= 0:
+        return np.empty(0, dtype=np.int64)
+    # 第k大的得分；與其同分的候選按下標順序補足，與穩定排序結果一致
+    kth_score = -np.partition(-scores, k - 1)[k - 1]
+    above = np.flatnonzero(scores > kth_score)
+    ties = np.flatnonzero(scores == kth_score)[:k - len(above)]
+    candidates = np.concatenate((above, ties))
+    return candidates[np.lexsort((candidates, -scores[candidates]))]
+
+def _fuse_and_topk(weighted, rerank, pc_weight, k):
+    """融合得分並返回得分最高的k個下標"""
+    return _topk_indices(_fuse_scores(weighted, rerank, pc_weight), k)
+
+class QueryBatcher:
+    """查詢向量化微批處理：合併時間窗口內的並發 embed_query 請求，一次 encode"""
+    def __init__(self, model, max_batch=32, max_wait_ms=40):
+        self.model = model
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def embed(self, text):
+        """提交單條查詢並阻塞等待批處理結果"""
+        future = Future()
+        self._queue.put((text, future))
+        return future.result()
+
+    def _run(self):
+        while True:
+            items = [self._queue.get()]
+            # 收集窗口期內的其他請求，直到達到批大小或超時
+            deadline = time.monotonic() + self.max_wait
+            while len(items) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    items.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            texts = [text for text, _ in items]
+            try:
+                embeddings = self.model.encode(
+                    texts,
+                    batch_size=len(texts),
+                    normalize_embeddings=True,
+                    convert_to_numpy=True
+                )
+                for (_, future), embedding in zip(items, embeddings):
+                    future.set_result(embedding.tolist())
+            except Exception as e:
+                for _, future in items:
+                    future.set_exception(e)
+
+class IncrementalEmbedder:
+    """增量向量化：生產端逐批送入文本，後台線程湊批編碼；建索引時直接取用已算好的向量"""
+    def __init__(self, embeddings, maxsize=INCREMENTAL_QUEUE_SIZE):
+        self.embeddings = embeddings
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._overflow = deque()  # 隊列已滿時暫存的文本（deque的append/popleft線程安全）
+        self._vectors = {}  # 文本 -> 向量
+        self._worker = threading.Thread(target=self._run, daemon=True)
+        self._worker.start()
+
+    def add(self, texts):
+        """
+        送入一批文本（不阻塞：調用方可能是虛擬問題生成的事件循環，阻塞會卡住所有進行中的請求）
+        隊列已滿時轉入溢出緩衝，由後台線程下次取批時一併處理
+        """
+        texts = list(texts)
+        try:
+            self._queue.put_nowait(texts)
+        except queue.Full:
+            self._overflow.extend(texts)
+
+    def _drain_overflow(self):
+        texts = []
+        while True:
+            try:
+                texts.append(self._overflow.popleft())
+            except IndexError:
+                return texts
+
+    def _run(self):
+        done = False
+        while not done:
+            batch = self._queue.get()
+            if batch is None:
+                batch = []
+                done = True
+            # 合併隊列中已到達的批次，湊滿一個編碼批次
+            while not done and len(batch) < EMBED_BATCH_SIZE:
+                try:
+                    more = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if more is None:
+                    done = True
+                    break
+                batch.extend(more)
+            batch.extend(self._drain_overflow())
+            texts = [text for text in dict.fromkeys(batch) if text not in self._vectors]
+            if not texts:
+                continue
+            try:
+                self._vectors.update(zip(texts, self.embeddings.embed_documents(texts)))
+            except Exception as e:
+                # 失敗的文本在建索引時重新向量化
+                print(f"增量向量化失敗: {e}")
+
+    def finish(self):
+        """結束輸入並等待剩餘批次（含溢出緩衝）完成
+        :return: {文本: 向量}
+        """
+        self._queue.put(None)
+        self._worker.join()
+        return self._vectors
+
+    def cancel(self):
+        """放棄剩餘輸入：清空隊列與溢出緩衝並通知後台線程退出（不等待進行中的批次）"""
+        self._overflow.clear()
+        while True:
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                break
+        self._queue.put(None)
+
+class ONNXReranker:
+    """ONNX Runtime 版重排模型：與 CrossEncoder 相同的分詞與權重，predict 接口一致"""
+    def __init__(self, model_name, onnx_path):
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        so = ort.SessionOptions()
+        so.intra_op_num_threads = os.cpu_count() or 1
+        so.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(onnx_path, sess_options=so, providers=["CPUExecutionProvider"])
+        self.input_names = {i.name for i in self.session.get_inputs()}
+
+    def predict(self, pairs):
+        """
+        :param pairs: [[query, passage], ...]
+        :return: 每對的相關性得分（單標籤輸出經Sigmoid，與CrossEncoder默認一致）
+        """
+        features = self.tokenizer(
+            [p[0] for p in pairs], [p[1] for p in pairs],
+            padding=True, truncation=True, max_length=RERANKER_MAX_LENGTH, return_tensors="np"
+        )
+        inputs = {name: value.astype(np.int64) for name, value in features.items() if name in self.input_names}
+        logits = self.session.run(None, inputs)[0][:, 0]
+        return 1 / (1 + np.exp(-logits))
+
+def load_reranker():
+    """載入重排模型：ONNX Runtime 可用且模型文件存在時使用，否則回退 CrossEncoder"""
+    if ort is not None and os.path.exists(RERANKER_ONNX_PATH):
+        try:
+            return ONNXReranker(RERANKER_MODEL, RERANKER_ONNX_PATH)
+        except Exception as e:
+            print(f"載入ONNX重排模型失敗，改用CrossEncoder: {e}")
+    return CrossEncoder(RERANKER_MODEL, device="cpu")
+
 class CustomEmbeddings(Embeddings):
     def __init__(self, model_name="paraphrase-multilingual-MiniLM-L12-v2"):
         super().__init__()
-        # 多語言模型：適配中英混合文件（作者名+中文查詢）
-        self.model = SentenceTransformer(model_name, device="cpu")
+        # 多語言模型：適配中英混合文件（作者名+中文查詢）；首次向量化時才載入
         self.model_name = model_name
+
+    @cached_property
+    def model(self):
+        return _get_cached_model(self.model_name, lambda: SentenceTransformer(self.model_name, device="cpu"))
+
+    @cached_property
+    def query_batcher(self):
+        return QueryBatcher(self.model)
     
     def embed_documents(self, texts):
-        embeddings = self.model.encode(texts, normalize_embeddings=True)
-        return embeddings.tolist()
+        # 直接返回float32矩陣：FAISS建索引時按np.array讀取，省去tolist的逐元素轉換
+        return self.model.encode(
+            texts,
+            batch_size=EMBED_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
     
     def embed_query(self, text):
-        embedding = self.model.encode(text, normalize_embeddings=True)
-        return embedding.tolist()
+        return self.query_batcher.embed(text)
     
     def __call__(self, text):
         return self.embed_query(text)
 
 def get_string_hash(s: str) -> str:
-    """生成字串的MD5 hash值"""
-    return hashlib.md5(s.encode('utf-8')).hexdigest()
+    """生成字串的BLAKE2b hash值（64位，16個十六進制字符；僅用於去重與路徑名，無需加密強度）"""
+    return hashlib.blake2b(s.encode('utf-8'), digest_size=8).hexdigest()
 
 class HierarchicalVectorStore:
     def __init__(self, persist_path="./data/faiss_index"):
         self.persist_path = persist_path
-        self.embeddings = CustomEmbeddings()
-        # 重排模型
-        self.reranker = CrossEncoder("cross-encoder/ms-marco-TinyBERT-L-2-v2", device="cpu")
+        _configure_torch_threads()
+        self.embeddings = CustomEmbeddings()  # 模型延遲到首次使用時載入
+        self._rerank_cache = OrderedDict()  # (查詢Hash, 内容Hash) -> reranker得分
+        self._rerank_lock = threading.Lock()
         self.hierarchical_index = defaultdict(lambda: defaultdict(dict))
         self.global_db = None
-        self.hash_mapping = {}
-        self.mapping_file = os.path.join(persist_path, "hash_mapping.json")
-        self._load_hash_mapping()
+        self._incremental = None  # 增量向量化器（僅在全新處理PDF期間存在）
+        self._row_features = {}  # 全局索引行號對齊的打分特徵列
+        self._row_docs = []
         self.processed_chunks = []
         self.adjacent_num = 2  # 上下文窗口
         # 平衡加權參數：避免單一維度（頁碼/章節）過度壓制語意相關內容
         self.page_chapter_weight = 6.0  
         self.semantic_base_weight = 2.0  # 語意匹配基礎分
+        if njit is not None:
+            # 預熱JIT（cache=True時後續啟動直接讀取編譯緩存）
+            _fuse_scores(np.zeros(1), np.zeros(1), self.page_chapter_weight)
 
     def load_index_from_path(self, index_path):
         """從指定路徑載入已儲存的向量索引"""
         try:
+            index_dir = os.path.join(index_path, INDEX_DIR)
+            if os.path.exists(os.path.join(index_dir, SHARD_MAP_FILE)):
+                return self._load_index_files(index_dir)
+            # 舊版目錄格式：LangChain global_index/ + hierarchical_mapping.json
             # 載入全域索引
             global_index_path = os.path.join(index_path, "global_index")
             if os.path.exists(global_index_path):
@@ -59,91 +361,260 @@ class HierarchicalVectorStore:
                     self.embeddings, 
                     allow_dangerous_deserialization=True
                 )
+                if self.global_db.index.metric_type == faiss.METRIC_INNER_PRODUCT:
+                    self.global_db.distance_strategy = DistanceStrategy.MAX_INNER_PRODUCT
+                self._build_row_features()
             
-            # 載入層次化索引
-            mapping_file = os.path.join(index_path, "hierarchical_mapping.json")
-            if os.path.exists(mapping_file):
-                with open(mapping_file, "r", encoding="utf-8") as f:
-                    index_mapping = json.load(f)
-                
-                for doc_hash in index_mapping:
-                    self.hierarchical_index[doc_hash] = {}
-                    for heading_hash in index_mapping[doc_hash]:
-                        index_dir = os.path.join(index_path, index_mapping[doc_hash][heading_hash])
-                        if os.path.exists(index_dir):
-                            db = FAISS.load_local(
-                                index_dir, 
-                                self.embeddings, 
-                                allow_dangerous_deserialization=True
-                            )
-                            # 反向查找原始標題和章節名
-                            doc_title = self.hash_mapping.get(doc_hash, "未知文檔")
-                            heading = self.hash_mapping.get(heading_hash, "未知章節")
-                            self.hierarchical_index[doc_title][heading] = db
+            # 舊版映射（每章節獨立索引目錄）不含行號：從全局索引的元數據重建分片
+            self.hierarchical_index.clear()
+            if self.global_db is not None:
+                self._rebuild_shards_from_global()
             
             return True
         except Exception as e:
             print(f"載入向量索引失敗: {e}")
             return False
-    
-    def _load_hash_mapping(self):
-        if os.path.exists(self.mapping_file):
-            try:
-                with open(self.mapping_file, "r", encoding="utf-8") as f:
-                    self.hash_mapping = json.load(f)
-                # 校驗hash映射表格式
-                if not isinstance(self.hash_mapping, dict):
-                    raise ValueError("哈希映射表不是字典格式")
-            except Exception as e:
-                print(f"加载哈希映射表失敗: {e}")
-                self.hash_mapping = {}
-                # 自動重建空的哈希映射表
-                self._save_hash_mapping()
+
+    def _load_index_files(self, index_path):
+        """載入單目錄索引：FAISS索引、文檔列表、分片行號範圍"""
+        index = faiss.read_index(os.path.join(index_path, INDEX_FILE))
+        with open(os.path.join(index_path, DOCUMENTS_FILE), "rb") as f:
+            documents = pickle.loads(f.read())
+        with open(os.path.join(index_path, SHARD_MAP_FILE), "r", encoding="utf-8") as f:
+            shard_map = json.load(f)
+        self.global_db = self._wrap_global_db(index, [
+            Document(page_content=content, metadata=metadata) for content, metadata in documents
+        ])
+        self._build_row_features()
+        self.hierarchical_index.clear()
+        for doc_title, heading, start, stop in shard_map:
+            self.hierarchical_index[doc_title][heading] = np.arange(start, stop, dtype=np.int64)
+        return True
+
+    def _save_index_files(self, save_path, shard_map):
+        """
+        寫入單目錄索引：先寫到臨時目錄，完成後整體替換舊目錄，避免寫入中斷留下不完整索引
+        只替換 save_path 下的專用子目錄，save_path 中的其他文件（如舊版索引）不受影響
+        :param shard_map: [(文檔標題, 章節, 起始行號, 結束行號), ...]
+        """
+        index_dir = os.path.join(save_path, INDEX_DIR)
+        tmp_path = index_dir + ".tmp"
+        old_path = index_dir + ".old"
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        os.makedirs(tmp_path)
+        faiss.write_index(self.global_db.index, os.path.join(tmp_path, INDEX_FILE))
+        documents = [(doc.page_content, doc.metadata) for doc in self._row_docs]
+        with open(os.path.join(tmp_path, DOCUMENTS_FILE), "wb") as f:
+            f.write(pickle.dumps(documents, protocol=pickle.HIGHEST_PROTOCOL))
+        with open(os.path.join(tmp_path, SHARD_MAP_FILE), "w", encoding="utf-8") as f:
+            json.dump(shard_map, f, ensure_ascii=False)
+        # 目錄不能原子覆蓋非空目錄：舊目錄先移開，新目錄改名到位後再刪除舊目錄
+        shutil.rmtree(old_path, ignore_errors=True)
+        if os.path.exists(index_dir):
+            os.replace(index_dir, old_path)
+        os.replace(tmp_path, index_dir)
+        shutil.rmtree(old_path, ignore_errors=True)
+
+    @cached_property
+    def reranker(self):
+        """重排模型（首次重排時載入，進程內共享）"""
+        return _get_cached_model(f"reranker:{RERANKER_MODEL}", load_reranker)
+
+    def begin_incremental_build(self):
+        """開始增量建索引：之後通過 add_chunks_incremental 送入的文本塊在後台提前向量化"""
+        self._finish_incremental()
+        self._incremental = IncrementalEmbedder(self.embeddings)
+
+    def add_chunks_incremental(self, chunks):
+        """送入已完成的文本塊（未調用 begin_incremental_build 時忽略）"""
+        incremental = self._incremental
+        if incremental is not None:
+            incremental.add(c["content"] for c in chunks if len(c["content"].strip()) > 10)
+
+    def cancel_incremental_build(self):
+        """中止增量建索引（處理失敗、未調用 build_hierarchical_index 時），釋放後台線程與已排隊的文本"""
+        incremental, self._incremental = self._incremental, None
+        if incremental is not None:
+            incremental.cancel()
+
+    def _finish_incremental(self):
+        """結束增量向量化，返回已算好的 {文本: 向量}"""
+        incremental, self._incremental = self._incremental, None
+        return incremental.finish() if incremental is not None else {}
+
+    def _embed_texts(self, texts, precomputed):
+        """向量化文本：優先使用增量階段已算好的向量，只補算缺失部分"""
+        if not precomputed:
+            return np.asarray(self.embeddings.embed_documents(texts), dtype=np.float32)
+        missing = [text for text in dict.fromkeys(texts) if text not in precomputed]
+        if missing:
+            precomputed = {**precomputed, **dict(zip(missing, self.embeddings.embed_documents(missing)))}
+        return np.stack([precomputed[text] for text in texts]).astype(np.float32, copy=False)
+
+    def _create_global_db(self, texts, metadatas, precomputed=None):
+        """向量化文本並建立全局FAISS內積索引（量化時先以全部向量訓練再寫入）"""
+        embeddings = self._embed_texts(texts, precomputed)
+        faiss.normalize_L2(embeddings)
+        if len(embeddings) >= HNSW_MIN_ROWS:
+            index = faiss.IndexHNSWFlat(embeddings.shape[1], HNSW_M, faiss.METRIC_INNER_PRODUCT)
+            index.hnsw.efConstruction = HNSW_EF_CONSTRUCTION
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+        elif QUANTIZE_INDEX:
+            index = faiss.IndexScalarQuantizer(
+                embeddings.shape[1], faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+            )
+            index.train(embeddings)
         else:
-            # 文件不存在時自動創建空文件
-            self.hash_mapping = {}
-            self._save_hash_mapping()
-            print(f"⚠️ Hash映射表不存在，已自動創建: {self.mapping_file}")
-    
-    def _save_hash_mapping(self):
-        """保存Hash映射表"""
-        try:
-            os.makedirs(self.persist_path, exist_ok=True)
-            with open(self.mapping_file, "w", encoding="utf-8") as f:
-                json.dump(self.hash_mapping, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            print(f"保存Hash映射表失敗: {e}")
-    
-    def _get_safe_path(self, original_name: str) -> str:
-        """生成安全的Hash路徑名（避免特殊字符）"""
-        if not original_name:
-            original_name = "empty_name"
-        # 查找已存在的哈希值
-        for hash_val, name in self.hash_mapping.items():
-            if name == original_name:
-                return hash_val
-        # 生成新哈希
-        hash_val = get_string_hash(original_name)
-        self.hash_mapping[hash_val] = original_name
-        self._save_hash_mapping()
-        return hash_val
+            index = faiss.IndexFlatIP(embeddings.shape[1])
+        index.add(embeddings)
+        return self._wrap_global_db(index, [
+            Document(page_content=text, metadata=metadata) for text, metadata in zip(texts, metadatas)
+        ])
+
+    def _wrap_global_db(self, index, documents):
+        """以LangChain FAISS對象保存索引與行號對齊的文檔（檢索直接調用FAISS索引）"""
+        return FAISS(
+            embedding_function=self.embeddings,
+            index=index,
+            docstore=InMemoryDocstore({str(row_id): doc for row_id, doc in enumerate(documents)}),
+            index_to_docstore_id={row_id: str(row_id) for row_id in range(len(documents))},
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+        )
 
+    def _build_row_features(self):
+        """
+        按全局索引行號預計算打分所需的列（頁碼、小寫內容與元數據），
+        並在每個文檔的元數據中記錄行號，供檢索結果對齊
+        """
+        row_docs = [
+            self.global_db.docstore.search(self.global_db.index_to_docstore_id[row_id])
+            for row_id in range(len(self.global_db.index_to_docstore_id))
+        ]
+        for row_id, doc in enumerate(row_docs):
+            doc.metadata["row_id"] = row_id
+        self._row_docs = row_docs  # 行號 -> 文檔，檢索時直接按下標取
+        metas = [doc.metadata for doc in row_docs]
+        # 章節/作者/標題按取值字典編碼：查詢時只需對少量不同取值做字符串匹配，再按編碼映射回各行
+        heading_values, heading_codes = np.unique(
+            np.array([meta.get("heading", "").lower() for meta in metas], dtype=str), return_inverse=True
+        )
+        author_values, author_codes = np.unique(
+            np.array([meta.get("author") or "" for meta in metas], dtype=str), return_inverse=True
+        )
+        doc_title_values, doc_title_codes = np.unique(
+            np.array([meta.get("doc_title") or "" for meta in metas], dtype=str), return_inverse=True
+        )
+        self._row_features = {
+            "page": np.array([meta.get("page", 0) for meta in metas], dtype=np.int64),
+            "heading_values": heading_values,
+            "heading_codes": heading_codes,
+            "author_values_lower": np.char.lower(author_values),
+            "has_author_values": np.char.strip(author_values) != "",
+            "author_codes": author_codes,
+            "doc_title_values_lower": np.char.lower(doc_title_values),
+            "has_title_values": doc_title_values != "",
+            "doc_title_codes": doc_title_codes,
+            # 小寫内容保持Python字符串列表：定長<U數組按最長塊分配每行內存，大索引時膨脹嚴重
+            "content_lower": [doc.page_content.lower() for doc in row_docs],
+            "virtual_questions_lower": [
+                [q.lower() for q in meta.get("virtual_questions", [])] for meta in metas
+            ],
+            # 舊版索引無 english_names 字段時從内容補算
+            "english_names": [
+                meta["english_names"] if "english_names" in meta
+                else tuple(n.lower() for n in _NAME_RE.findall(doc.page_content))
+                for doc, meta in zip(row_docs, metas)
+            ],
+        }
+
+    def _rebuild_shards_from_global(self):
+        """按全局索引中每行的文檔標題/章節重建分片行號"""
+        shard_rows = defaultdict(lambda: defaultdict(list))
+        for row_id, docstore_id in self.global_db.index_to_docstore_id.items():
+            meta = self.global_db.docstore.search(docstore_id).metadata
+            shard_rows[meta["doc_title"]][meta["heading"]].append(row_id)
+        for doc_title, headings in shard_rows.items():
+            for heading, row_ids in headings.items():
+                self.hierarchical_index[doc_title][heading] = np.asarray(row_ids, dtype=np.int64)
+
+    def _search_rows(self, query_vector, k, params=None):
+        """
+        直接在全局FAISS索引上檢索，按行號取文檔（不經LangChain封裝）
+        :param query_vector: 形狀 (1, dim) 的 float32 查詢向量（已歸一化）
+        :param k: 召回數量
+        :param params: 可選的 faiss.SearchParameters（如限定行號）
+        :return: 文檔列表（按相似度排序）
+        """
+        index = self.global_db.index
+        if isinstance(index, faiss.IndexHNSW):
+            if params is not None:
+                # 限定行號的分片檢索：HNSW圖過濾會漏召回，改在底層平面向量上精確檢索
+                index = faiss.downcast_index(index.storage)
+            else:
+                # 召回數量大於efSearch時相應放大候選集
+                params = faiss.SearchParametersHNSW(efSearch=max(HNSW_EF_SEARCH, k))
+        _, indices = index.search(query_vector, k, params=params)
+        return [self._row_docs[i] for i in indices[0] if i != -1]
+
+    def _search_shard(self, query_vector, row_ids, k):
+        """
+        在全局索引中只檢索指定分片（IDSelectorBatch 限定行號）
+        :param query_vector: 形狀 (1, dim) 的 float32 查詢向量
+        :param row_ids: 分片在全局索引中的行號
+        :param k: 召回數量
+        :return: 文檔列表（按相似度排序）
+        """
+        k = min(k, len(row_ids))
+        if k <= 0:
+            return []
+        return self._search_rows(query_vector, k, faiss.SearchParameters(sel=faiss.IDSelectorBatch(row_ids)))
+    
     def set_processed_chunks(self, chunks):
         """設置已處理的文本塊（用於上下文擴展）"""
         self.processed_chunks = chunks
     
+    def _adjacent_range(self, target_idx, total_chunks):
+        """相鄰塊在 processed_chunks 中的切片範圍 (start, stop)；無法擴展時返回None"""
+        if not self.processed_chunks or target_idx == -1 or total_chunks == 0:
+            return None
+        start_idx = max(0, target_idx - self.adjacent_num)
+        end_idx = min(total_chunks - 1, target_idx + self.adjacent_num)
+        return start_idx, end_idx + 1
+
     def get_adjacent_chunks(self, target_chunk):
         """獲取目標塊的相鄰塊（擴大上下文窗口）"""
-        if not self.processed_chunks:
+        adjacent_range = self._adjacent_range(target_chunk.get("chunk_idx", -1), target_chunk.get("total_chunks", 0))
+        if adjacent_range is None:
             return [target_chunk]
-        target_idx = target_chunk.get("chunk_idx", -1)
-        total_chunks = target_chunk.get("total_chunks", 0)
-        if target_idx == -1 or total_chunks == 0:
-            return [target_chunk]
-        start_idx = max(0, target_idx - self.adjacent_num)
-        end_idx = min(total_chunks - 1, target_idx + self.adjacent_num)
-        adjacent_chunks = [self.processed_chunks[idx] for idx in range(start_idx, end_idx + 1)]
-        return adjacent_chunks
+        return self.processed_chunks[adjacent_range[0]:adjacent_range[1]]
+
+    def _iter_context_chunks(self, ranked_docs):
+        """按排名依次產出每個文檔的相鄰塊（按chunk_idx去重），無法擴展時產出文檔本身"""
+        seen_idx = set()
+        for doc in ranked_docs:
+            adjacent_range = self._adjacent_range(doc.metadata["chunk_idx"], doc.metadata["total_chunks"])
+            if adjacent_range is None:
+                adjacent_chunks = [self._doc_to_chunk(doc)]
+            else:
+                adjacent_chunks = self.processed_chunks[adjacent_range[0]:adjacent_range[1]]
+            for ac in adjacent_chunks:
+                if ac["chunk_idx"] not in seen_idx:
+                    seen_idx.add(ac["chunk_idx"])
+                    yield ac
+
+    @staticmethod
+    def _doc_to_chunk(doc):
+        """檢索結果文檔轉為文本塊字典（無法擴展上下文時直接返回）"""
+        return {
+            "content": doc.page_content,
+            "page": doc.metadata["page"],
+            "heading": doc.metadata["heading"],
+            "author": doc.metadata["author"],
+            "doc_title": doc.metadata["doc_title"],
+            "virtual_questions": doc.metadata["virtual_questions"],
+            "chunk_idx": doc.metadata["chunk_idx"],
+            "total_chunks": doc.metadata["total_chunks"]
+        }
 
     def build_hierarchical_index(self, chunks_with_meta, save_path=None):
         """
@@ -154,53 +625,20 @@ class HierarchicalVectorStore:
         """
         if save_path is None:
             save_path = self.persist_path
+        precomputed = self._finish_incremental()
         try:
-            os.makedirs(self.persist_path, exist_ok=True)
-            hierarchical_groups = defaultdict(lambda: defaultdict(list))
-            
-            # 按文檔標題和章節分組
-            for chunk in chunks_with_meta:
-                doc_title = chunk["doc_title"]
-                heading = chunk["heading"]
-                hierarchical_groups[doc_title][heading].append(chunk)
-            
+            # 分片記錄的是當前全局索引的行號，重建前清空舊分片
+            self.hierarchical_index.clear()
             # 過濾無效塊（空/過短內容）
-            def filter_valid_chunks(chunks):
-                return [c for c in chunks if len(c["content"].strip()) > 10]
-            
-            # 構建分層索引
-            for doc_title in hierarchical_groups:
-                doc_hash = self._get_safe_path(doc_title)
-                for heading in hierarchical_groups[doc_title]:
-                    heading_hash = self._get_safe_path(heading)
-                    chunks = filter_valid_chunks(hierarchical_groups[doc_title][heading])
-                    if not chunks:
-                        continue
-                    # 提取文本和元數據
-                    texts = [c["content"] for c in chunks]
-                    metadatas = [
-                        {
-                            "page": c["page"],
-                            "heading": c["heading"],
-                            "author": c["author"],
-                            "doc_title": c["doc_title"],
-                            "virtual_questions": c["virtual_questions"],
-                            "chunk_idx": c["chunk_idx"],
-                            "total_chunks": c["total_chunks"],
-                            "content_hash": get_string_hash(c["content"])
-                        }
-                        for c in chunks
-                    ]
-                    # 構建FAISS索引
-                    db = FAISS.from_texts(texts, self.embeddings, metadatas=metadatas)
-                    self.hierarchical_index[doc_title][heading] = db
-                    # 保存索引到本地
-                    save_dir = os.path.join(self.persist_path, f"{doc_hash}_{heading_hash}_index")
-                    os.makedirs(save_dir, exist_ok=True)
-                    db.save_local(save_dir)
+            valid_chunks = [c for c in chunks_with_meta if len(c["content"].strip()) > 10]
+            # 按（文檔標題, 章節）首次出現順序穩定排序，使同一分片的行號連續
+            shard_key = itemgetter("doc_title", "heading")
+            shard_order = {}
+            for c in valid_chunks:
+                shard_order.setdefault(shard_key(c), len(shard_order))
+            all_chunks = sorted(valid_chunks, key=lambda c: shard_order[shard_key(c)])
             
-            # 構建全局索引（包含所有有效塊）
-            all_chunks = filter_valid_chunks(chunks_with_meta)
+            # 構建全局索引（包含所有有效塊）；章節分片只記錄行號，不再單獨建索引
             all_texts = [c["content"] for c in all_chunks]
             all_metadatas = [
                 {
@@ -211,26 +649,26 @@ class HierarchicalVectorStore:
                     "virtual_questions": c["virtual_questions"],
                     "chunk_idx": c["chunk_idx"],
                     "total_chunks": c["total_chunks"],
-                    "content_hash": get_string_hash(c["content"])
+                    "content_hash": get_string_hash(c["content"]),
+                    # 建索引時預提取英文名字（原文大小寫），查詢時無需再掃描内容
+                    "english_names": tuple(n.lower() for n in _NAME_RE.findall(c["content"]))
                 }
                 for c in all_chunks
             ]
-            self.global_db = FAISS.from_texts(all_texts, self.embeddings, metadatas=all_metadatas)
-            global_save_path = os.path.join(self.persist_path, "global_index")
-            os.makedirs(global_save_path, exist_ok=True)
-            self.global_db.save_local(global_save_path)
+            self.global_db = self._create_global_db(all_texts, all_metadatas, precomputed)
+            self._build_row_features()
             
-            # 保存分層索引映射關係
-            index_mapping = {}
-            for doc_title in self.hierarchical_index:
-                doc_hash = self._get_safe_path(doc_title)
-                index_mapping[doc_hash] = {}
-                for heading in self.hierarchical_index[doc_title]:
-                    heading_hash = self._get_safe_path(heading)
-                    index_mapping[doc_hash][heading_hash] = f"{doc_hash}_{heading_hash}_index"
+            # 單次遍歷已排序塊，每個（文檔標題, 章節）對應全局索引中一段連續行號
+            shard_map = []
+            start = 0
+            for (doc_title, heading), group in groupby(all_chunks, key=shard_key):
+                stop = start + sum(1 for _ in group)
+                shard_map.append((doc_title, heading, start, stop))
+                self.hierarchical_index[doc_title][heading] = np.arange(start, stop, dtype=np.int64)
+                start = stop
             
-            with open(os.path.join(self.persist_path, "hierarchical_mapping.json"), "w", encoding="utf-8") as f:
-                json.dump(index_mapping, f, ensure_ascii=False, indent=2)
+            # 索引、文檔與分片範圍寫入同一目錄（整體替換）
+            self._save_index_files(save_path, shard_map)
             
             return True
         except Exception as e:
@@ -247,57 +685,62 @@ class HierarchicalVectorStore:
         :param top_k: 最終傳回的文件數量
         :return: (doc_scores: 文件分數映射, final_matched: 篩選後的文檔清單)
         """
-        matched_docs = []
         query_lower = query.lower()
         # 解析頁碼/章節
         page_nums = parse_page_query(query)
         chapter_name, _ = parse_chapter_query(query)
         chapter_name_lower = chapter_name.lower() if chapter_name else ""
 
-        # 第一步：計算每個文檔的綜合得分（語義+加權）
+        # 第一步：計算每個文檔的綜合得分（語義+加權），按全局索引行號向量化計算
         doc_scores = {}  # 得分映射：content_hash -> (score, doc)
-        for doc in docs:
-            score = self.semantic_base_weight  # 語義匹配基礎分（保底）
-            content = doc.page_content.lower()
-            meta = doc.metadata
-            doc_page = meta.get("page", 0)
-            doc_heading_lower = meta.get("heading", "").lower()
-            content_hash = meta.get("content_hash", "")
-
-            # 1. 頁碼/章節加權（可控優先级）
-            if page_nums and doc_page in page_nums:
-                score += self.page_chapter_weight
-            if chapter_name and chapter_name_lower in doc_heading_lower:
-                score += self.page_chapter_weight
-
-            # 2. 元數據匹配（作者/標題）
-            if meta.get("author") and meta["author"].strip():
-                # 只要元數據有作者，無論是否匹配query，都加基礎分
-                score += 1.5
-                if meta["author"].lower() in query_lower:
-                    score += 2.0
-            if meta.get("doc_title") and meta["doc_title"].lower() in query_lower:
-                score += 1.5
-
-            # 3. 虛擬問題匹配
-            virtual_questions = meta.get("virtual_questions", [])
-            for q in virtual_questions:
-                if q.lower() in query_lower or query_lower in q.lower():
-                    score += 1.8
-
-            # 4. 内容關鍵詞匹配（兼容中英文）
-            # 提取query中的核心詞（長度≥2）
-            query_keywords = [kw for kw in re.findall(r'\w+', query_lower) if len(kw) >= 2]
-            for kw in query_keywords:
-                if kw in content:
-                    score += 0.5
-            # 英文名字匹配（作者名通常是「名+姓」）
-            english_names = re.findall(r'[A-Z][a-z]+\s+[A-Z][a-z]+', content)
-            for name in english_names:
-                if name.lower() in query_lower:
-                    score += 3.0
-
-            # 保存得分（按内容Hash去重，保留最高分）
+        if not docs:
+            return doc_scores, []
+        features = self._row_features
+        rows = np.fromiter((doc.metadata["row_id"] for doc in docs), dtype=np.int64, count=len(docs))
+        scores = np.full(len(docs), self.semantic_base_weight)  # 語義匹配基礎分（保底）
+
+        # 1. 頁碼/章節加權（可控優先级）
+        if page_nums:
+            scores += self.page_chapter_weight * np.isin(features["page"][rows], page_nums)
+        if chapter_name:
+            heading_hit = np.char.find(features["heading_values"], chapter_name_lower) >= 0
+            scores += self.page_chapter_weight * heading_hit[features["heading_codes"][rows]]
+
+        # 2. 元數據匹配（作者/標題）
+        # 只要元數據有作者，無論是否匹配query，都加基礎分
+        has_author = features["has_author_values"]
+        author_hit = has_author & (np.char.find(query_lower, features["author_values_lower"]) >= 0)
+        title_hit = features["has_title_values"] & (np.char.find(query_lower, features["doc_title_values_lower"]) >= 0)
+        author_codes = features["author_codes"][rows]
+        scores += 1.5 * has_author[author_codes]
+        scores += 2.0 * author_hit[author_codes]
+        scores += 1.5 * title_hit[features["doc_title_codes"][rows]]
+
+        # 3. 虛擬問題匹配
+        virtual_questions_lower = features["virtual_questions_lower"]
+        for i, row in enumerate(rows):
+            for q_lower in virtual_questions_lower[row]:
+                if q_lower in query_lower or query_lower in q_lower:
+                    scores[i] += 1.8
+
+        # 4. 内容關鍵詞匹配（兼容中英文）
+        # 提取query中的核心詞（長度≥2）
+        # 只取候選行的内容做子串匹配
+        content_lower = features["content_lower"]
+        contents_lower = [content_lower[row] for row in rows]
+        query_keywords = [kw for kw in _WORD_RE.findall(query_lower) if len(kw) >= 2]
+        for kw in query_keywords:
+            scores += 0.5 * np.fromiter((kw in c for c in contents_lower), dtype=bool, count=len(contents_lower))
+        # 英文名字匹配（作者名通常是「名+姓」，建索引時已預提取）
+        english_names = features["english_names"]
+        for i, row in enumerate(rows):
+            for name in english_names[row]:
+                if name in query_lower:
+                    scores[i] += 3.0
+
+        # 保存得分（按内容Hash去重，保留最高分）
+        for doc, score in zip(docs, scores.tolist()):
+            content_hash = doc.metadata.get("content_hash", "")
             if content_hash in doc_scores:
                 if score > doc_scores[content_hash][0]:
                     doc_scores[content_hash] = (score, doc)
@@ -305,8 +748,9 @@ class HierarchicalVectorStore:
                 doc_scores[content_hash] = (score, doc)
 
         # 第二步：排序+截斷
-        sorted_docs = sorted(doc_scores.values(), key=lambda x: x[0], reverse=True)
-        final_matched = [doc for (score, doc) in sorted_docs[:top_k]]
+        scored_docs = list(doc_scores.values())
+        top_idx = _topk_indices(np.fromiter((score for score, _ in scored_docs), dtype=np.float64, count=len(scored_docs)), top_k)
+        final_matched = [scored_docs[i][1] for i in top_idx]
 
         # 第三步：兜底召回（保證數量）
         if len(final_matched) < top_k:
@@ -320,6 +764,39 @@ class HierarchicalVectorStore:
 
         return doc_scores, final_matched
 
+    def _rerank_scores(self, query, docs):
+        """取得reranker得分：命中緩存的直接復用，只對未命中的文檔調用模型"""
+        query_hash = get_string_hash(query)
+        keys = [(query_hash, doc.metadata.get("content_hash", "")) for doc in docs]
+        scores = np.empty(len(docs), dtype=np.float64)
+        miss_idx = []
+        with self._rerank_lock:
+            for i, key in enumerate(keys):
+                score = self._rerank_cache.get(key)
+                if score is None:
+                    miss_idx.append(i)
+                else:
+                    self._rerank_cache.move_to_end(key)
+                    scores[i] = score
+        if miss_idx:
+            miss_scores = self.reranker.predict([[query, docs[i].page_content] for i in miss_idx])
+            with self._rerank_lock:
+                for i, score in zip(miss_idx, np.asarray(miss_scores, dtype=np.float64).tolist()):
+                    scores[i] = score
+                    self._rerank_cache[keys[i]] = score
+                while len(self._rerank_cache) > RERANK_CACHE_SIZE:
+                    self._rerank_cache.popitem(last=False)
+        return scores
+
+    @staticmethod
+    def _extend_unique(matched_docs, seen_hash, docs):
+        """合併召回結果，跳過内容Hash已出現的文檔"""
+        for doc in docs:
+            content_hash = doc.metadata.get("content_hash", "")
+            if content_hash not in seen_hash:
+                seen_hash.add(content_hash)
+                matched_docs.append(doc)
+
     def hierarchical_search(self, query, top_k=5):
         """
         層次化擷取（優先標題/章節→全域擷取→加權重排→上下文擴展）
@@ -332,8 +809,12 @@ class HierarchicalVectorStore:
         
         query_lower = query.lower()
         matched_docs = []
+        seen_hash = set()  # 召回時即按内容Hash去重
         matched_doc_titles = []
         expand_factor = 5  # 擴容因子：提升召回率
+        # 查詢只向量化一次，全局檢索與各分片共用同一向量
+        query_vector = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+        faiss.normalize_L2(query_vector)
 
         # 1. 層次化語義檢索（優先標題/章節）
         for doc_title in self.hierarchical_index:
@@ -341,6 +822,7 @@ class HierarchicalVectorStore:
                 matched_doc_titles.append(doc_title)
         
         if matched_doc_titles:
+            search_tasks = []  # (分片行號, 召回數量)
             for doc_title in matched_doc_titles:
                 matched_headings = []
                 for heading in self.hierarchical_index[doc_title]:
@@ -350,80 +832,41 @@ class HierarchicalVectorStore:
                 if matched_headings:
                     # 匹配到章節：針對性檢索
                     for heading in matched_headings:
-                        db = self.hierarchical_index[doc_title][heading]
-                        docs = db.similarity_search(query, k=top_k*expand_factor)
-                        matched_docs.extend(docs)
+                        row_ids = self.hierarchical_index[doc_title][heading]
+                        search_tasks.append((row_ids, top_k*expand_factor))
                 else:
                     # 無匹配章節：均分召回數量到所有章節
                     heading_count = len(self.hierarchical_index[doc_title])
                     k_per_heading = max(1, top_k*expand_factor // heading_count)
-                    for heading, db in self.hierarchical_index[doc_title].items():
-                        docs = db.similarity_search(query, k=k_per_heading)
-                        matched_docs.extend(docs)
+                    for heading, row_ids in self.hierarchical_index[doc_title].items():
+                        search_tasks.append((row_ids, k_per_heading))
+            # 所有分片在全局索引上並行檢索，結果按任務順序合併
+            for docs in _SEARCH_EXECUTOR.map(
+                lambda task: self._search_shard(query_vector, task[0], task[1]),
+                search_tasks
+            ):
+                self._extend_unique(matched_docs, seen_hash, docs)
         else:
             # 無匹配標題：全局檢索
             if self.global_db:
-                matched_docs = self.global_db.similarity_search(query, k=top_k*expand_factor)
+                self._extend_unique(matched_docs, seen_hash, self._search_rows(query_vector, top_k*expand_factor))
 
-        # 2. 加權關鍵詞匹配
-        doc_scores, matched_docs = self.enhanced_keyword_match(query, matched_docs, top_k=top_k*2)
+        # 2. 加權關鍵詞匹配（返回結果按内容Hash唯一）
+        doc_scores, unique_docs = self.enhanced_keyword_match(query, matched_docs, top_k=top_k*2)
 
-        # 3. 去重（按内容Hash）
-        seen_hash = set()
-        unique_docs = []
-        for doc in matched_docs:
-            content_hash = doc.metadata.get("content_hash", "")
-            if content_hash not in seen_hash:
-                seen_hash.add(content_hash)
-                unique_docs.append(doc)
-
-        # 4. 重排（reranker）：融合加權得分和reranker得分
-        final_ranked = []
-        if len(unique_docs) > 0:
-            pairs = [[query, doc.page_content] for doc in unique_docs]
-            scores = self.reranker.predict(pairs)
-            # 融合加權得分和reranker得分（避免reranker完全覆蓋加權）
-            fused_scores = []
-            for i, (score, doc) in enumerate(zip(scores, unique_docs)):
-                # 加權得分（標準化） + reranker得分（標準化）
-                content_hash = doc.metadata.get("content_hash", "")
-                weighted_score = doc_scores.get(content_hash, (0,))[0]
-                norm_weighted = weighted_score / (self.page_chapter_weight * 2)  # 標準化到0-1
-                norm_rerank = (score - min(scores)) / (max(scores) - min(scores) + 1e-6)  # 標準化到0-1
-                fused = 0.6 * norm_weighted + 0.4 * norm_rerank  # 加權得分占60%，reranker占40%
-                fused_scores.append((fused, doc))
-            # 按融合得分排序
-            fused_scores = sorted(fused_scores, key=lambda x: x[0], reverse=True)
-            final_ranked = [item[1] for item in fused_scores[:top_k]]
-        else:
-            final_ranked = []
-
-        # 5. 上下文增强（擴大相鄰塊）
-        target_chunk_list = []
-        for doc in final_ranked:
-            target_chunk = {
-                "content": doc.page_content,
-                "page": doc.metadata["page"],
-                "heading": doc.metadata["heading"],
-                "author": doc.metadata["author"],
-                "doc_title": doc.metadata["doc_title"],
-                "virtual_questions": doc.metadata["virtual_questions"],
-                "chunk_idx": doc.metadata["chunk_idx"],
-                "total_chunks": doc.metadata["total_chunks"]
-            }
-            target_chunk_list.append(target_chunk)
-        
-        # 去重+合併相鄰塊
-        all_context_chunks = []
-        seen_idx = set()
-        for chunk in target_chunk_list:
-            adjacent_chunks = self.get_adjacent_chunks(chunk)
-            for ac in adjacent_chunks:
-                if ac["chunk_idx"] not in seen_idx:
-                    seen_idx.add(ac["chunk_idx"])
-                    all_context_chunks.append(ac)
+        if not unique_docs:
+            return []
+
+        # 3. 重排（reranker）：融合加權得分和reranker得分（避免reranker完全覆蓋加權）
+        scores = self._rerank_scores(query, unique_docs)
+        weighted_scores = np.fromiter(
+            (doc_scores.get(doc.metadata.get("content_hash", ""), (0,))[0] for doc in unique_docs),
+            dtype=np.float64, count=len(unique_docs)
+        )
+        top_idx = _fuse_and_topk(weighted_scores, scores, float(self.page_chapter_weight), top_k)
 
-        return all_context_chunks
+        # 4. 上下文增强（擴大相鄰塊）：按排名直接展開相鄰塊並去重，不再構建中間列表
+        return list(self._iter_context_chunks(unique_docs[i] for i in top_idx))
 
 # 兼容原有接口
 class VectorStoreManager(HierarchicalVectorStore):
@@ -1,6 +1,5 @@
 import os
 import sys
-from ui.app import PDFChatApp
 
 def main():
     # 確保data目錄存在
@@ -18,7 +17,9 @@ def main():
             print(f"創建目錄失敗 {dir_path}: {e}")
             sys.exit(1)
     
-    # 啟動應用
+    # 啟動應用（在函數內導入：spawn方式啟動的PDF解析子進程會重新執行本模組頂層，
+    # 不能在此處連帶載入界面、torch 和 faiss）
+    from ui.app import PDFChatApp
     app = PDFChatApp()
     app.mainloop()
 
@@ -1,11 +1,13 @@
 import customtkinter as ctk
-from tkinter import filedialog, END, PhotoImage
+from tkinter import filedialog, END, PhotoImage, TclError
 import threading
+import base64
+from concurrent.futures import ThreadPoolExecutor
 import os
 import time
 import random
-import re
 from datetime import datetime
+from pathlib import Path
 from functools import wraps
 # 新增：用于讀寫.env文件的库
 from dotenv import load_dotenv, set_key
@@ -14,38 +16,54 @@ from core.pdf_processor import PDFProcessor
 from core.vector_store import VectorStoreManager
 from core.rag_chain import RAGEngine
 from core.file_cache import FileCacheManager
+from core.answer_cache import AnswerCache, is_targeted_query
+from core.utils import clean_question_serial_number, collect_virtual_questions
 
 # 全域樣式配置
 ctk.set_appearance_mode("dark")
 ctk.set_default_color_theme("blue")
 
-# ===================== 問題序號清洗工具函數 =====================
-def clean_question_serial_number(question: str) -> str:
-    if not question:
-        return question
-    serial_pattern = r'^\s*[(【[]?(\d+|[一二三四五六七八九十百千]+)[.、)\]\s]\s*'
-    cleaned_question = re.sub(serial_pattern, '', question.strip())
-    return cleaned_question.strip()
+# 界面資源目錄與.env路徑（模組載入時計算一次）
+_ASSETS = Path(__file__).resolve().parent / "assets"
+_ENV_PATH = Path.cwd() / ".env"
+
+# 消息氣泡批量落地/流式回答刷新的間隔（約一幀）
+MESSAGE_FLUSH_MS = 16
+# 匯出對話記錄的文件緩衝區大小
+EXPORT_BUFFER_SIZE = 1 << 16  # 64 KiB
+# 匯出文件頁首模板
+_EXPORT_SEPARATOR = "=" * 50
+_EXPORT_HEADER_TEMPLATE = f"{_EXPORT_SEPARATOR}\n匯出時間：{{time}}\n關聯文檔：{{doc}}\n{_EXPORT_SEPARATOR}\n"
+# 匯出對話框的文件類型
+_EXPORT_FILETYPES = (("文本文件", "*.txt"), ("Markdown文件", "*.md"), ("所有文件", "*.*"))
+_EXPORT_DEFAULT_EXTENSION = ".txt"
+# 短時後台任務線程數（讀取Icon、匯出寫文件）
+BACKGROUND_WORKERS = 2
 
 # ===================== 節流裝飾器 =====================
 def throttle(ms):
     def decorator(func):
-        last_call = 0
+        last_call = 0  # 單調時鐘（ns），不受系統校時影響
+        interval_ns = ms * 1_000_000
         lock = threading.Lock()
         
         @wraps(func)
         def wrapper(*args, **kwargs):
             nonlocal last_call
             force = kwargs.pop('force', False)
-            now = time.time() * 1000
+            now = time.monotonic_ns()
             
             with lock:
-                if force or (now - last_call >= ms):
+                if force or (now - last_call >= interval_ns):
                     last_call = now
                     return func(*args, **kwargs)
         return wrapper
     return decorator
 
+def _strip_if_padded(text):
+    """首尾有空白時才strip（已整潔的長回答不必複製）"""
+    return text.strip() if text[0].isspace() or text[-1].isspace() else text
+
 class MessageBubble(ctk.CTkFrame):
     def __init__(self, master, sender, message, **kwargs):
         super().__init__(master,** kwargs)
@@ -110,7 +128,6 @@ class MessageBubble(ctk.CTkFrame):
         try:
             self.clipboard_clear()
             self.clipboard_append(self.message)
-            self.update()
             self.copy_hint.place(relx=0.5, rely=1.1, anchor="n")
             self.after(2000, lambda: self.copy_hint.place_forget())
         except Exception as e:
@@ -119,27 +136,10 @@ class MessageBubble(ctk.CTkFrame):
             self.after(2000, lambda: self.copy_hint.place_forget())
 
 class PDFChatApp(ctk.CTk):
+    _icon_png_data = None  # PNG Icon 的base64數據（類級緩存，只讀一次文件）
+
     def __init__(self):
         super().__init__()
-        # 設置Icon
-        icon_path = os.path.join(os.path.dirname(__file__), "assets", "icon.ico")
-        if os.path.exists(icon_path):
-            try:
-                self.iconbitmap(icon_path)
-            except Exception as e:
-                print(f"設置Icon失敗：{str(e)}")
-                pass  # 忽略錯誤，繼續使用預設Icon
-        else:
-            # 嘗試載入 PNG 作為備選
-            png_path = os.path.join(os.path.dirname(__file__), "assets", "icon.png")
-            if os.path.exists(png_path):
-                try:
-                    img = PhotoImage(file=png_path)
-                    self.iconphoto(True, img)
-                except Exception as e:
-                    print(f"設置Icon失敗：{str(e)}")
-                    pass
-
         self.title("Local PDF Chat Application")
         self.geometry("1200x800")
         self.resizable(True, True)
@@ -148,10 +148,23 @@ class PDFChatApp(ctk.CTk):
         self.model_loaded = False
         self.is_processing = False
         self.current_file = None
+        self.current_file_hash = None
         self.all_virtual_questions = []
+        self._latest_ai_answer = ""
+        self._msg_queue = []  # 待創建的消息氣泡 (發送者, 內容)
+        self._flush_scheduled = False
+        self._bubbles = []  # 已創建的消息氣泡（按顯示順序）
+        self._stream_update_pending = False  # 已排隊的流式回答刷新
+        self._closing = False  # 窗口已關閉：後台線程停止回調界面
+        self._hash_cache = {}  # (路徑, 修改時間ns, 大小) -> 文件Hash的Future
+        self._hash_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="file-hash")
+        # 短時後台任務（讀取Icon、匯出寫文件）的復用線程池
+        self._executor = ThreadPoolExecutor(max_workers=BACKGROUND_WORKERS, thread_name_prefix="worker")
+        self._icon_img = None
+        self._set_window_icon()
 
         # ===================== 初始化.env文件和API Key =====================
-        self.env_path = os.path.join(os.getcwd(), ".env")  # .env檔在項目根目錄
+        self.env_path = _ENV_PATH  # .env檔在項目根目錄
         self._init_env_file()  # 初始化.env文件（不存在則創建）
         load_dotenv(self.env_path)  # 加載環境變量
         self.deepseek_api_key = os.getenv("DEEPSEEK_API_KEY", "")  # 讀取已保存的API Key
@@ -159,15 +172,77 @@ class PDFChatApp(ctk.CTk):
         self.pdf_processor = PDFProcessor()
         self.rag_engine = RAGEngine()
         self.file_cache = FileCacheManager()
+        self.answer_cache = AnswerCache()
         self.vector_store = None
 
         self._setup_ui()
         self._preload_model_async()
+        self.protocol("WM_DELETE_WINDOW", self._on_close)
+
+    def _set_window_icon(self):
+        """設置窗口Icon：優先ICO；PNG備選在後台讀取文件，讀完後回到主線程設置（Tk控件只能在主線程創建）"""
+        icon_path = _ASSETS / "icon.ico"
+        if icon_path.is_file():
+            try:
+                self.iconbitmap(str(icon_path))
+            except Exception as e:
+                print(f"設置Icon失敗：{str(e)}")
+                pass  # 忽略錯誤，繼續使用預設Icon
+            return
+        # 嘗試載入 PNG 作為備選
+        png_path = _ASSETS / "icon.png"
+        if not png_path.is_file():
+            return
+        if PDFChatApp._icon_png_data is not None:
+            self._apply_png_icon(PDFChatApp._icon_png_data)
+            return
+
+        def read_png():
+            try:
+                with open(png_path, "rb") as f:
+                    PDFChatApp._icon_png_data = base64.b64encode(f.read())
+            except Exception as e:
+                print(f"設置Icon失敗：{str(e)}")
+                return
+            self._post(lambda: self._apply_png_icon(PDFChatApp._icon_png_data))
+
+        self._executor.submit(read_png)
+
+    def _apply_png_icon(self, png_data):
+        try:
+            # 保留引用，避免圖片被回收
+            self._icon_img = PhotoImage(data=png_data)
+            self.iconphoto(True, self._icon_img)
+        except Exception as e:
+            print(f"設置Icon失敗：{str(e)}")
+
+    def _start_background(self, target):
+        """
+        在守護線程中執行耗時任務（模型加載/PDF處理/問答，可能持續數分鐘）
+        線程池的工作線程非守護，解釋器退出時會等待其結束；守護線程隨窗口關閉直接退出
+        """
+        threading.Thread(target=target, daemon=True).start()
+
+    def _post(self, callback, delay=0):
+        """後台線程把界面更新投遞到主線程；窗口關閉後直接丟棄"""
+        if self._closing:
+            return
+        try:
+            self.after(delay, callback)
+        except (RuntimeError, TclError):
+            pass  # 檢查與投遞之間窗口剛被銷毀
+
+    def _on_close(self):
+        """關閉窗口：標記關閉（後台線程不再回調界面），取消未開始的短時任務後銷毀窗口"""
+        self._closing = True
+        self._executor.shutdown(wait=False, cancel_futures=True)
+        self._hash_executor.shutdown(wait=False, cancel_futures=True)
+        self.destroy()
 
     # ===================== 初始化.env文件 =====================
     def _init_env_file(self):
         """如果.env檔案不存在則創建空文件"""
-        if not os.path.exists(self.env_path):
+        if not self.env_path.exists():
             try:
                 with open(self.env_path, "w", encoding="utf-8") as f:
                     f.write("# DeepSeek API Configuration\n")
@@ -176,6 +251,8 @@ class PDFChatApp(ctk.CTk):
                 print(f"創建.env文件失敗：{str(e)}")
 
     def _setup_ui(self):
+        # 構建期間隱藏窗口，全部控件創建完成後只做一次佈局再顯示
+        self.withdraw()
         self.sidebar = ctk.CTkFrame(self, width=300, corner_radius=0)
         self.sidebar.pack(side="left", fill="y", padx=0, pady=0)
         self.sidebar.pack_propagate(False)
@@ -254,7 +331,12 @@ class PDFChatApp(ctk.CTk):
             height=200
         )
         self.recommend_buttons_frame.pack(fill="both", expand=True)
-        self.recommend_buttons = []
+        self.recommend_buttons = []  # 推薦問題標籤池（復用）
+        self.recommend_empty_label = None
+        self._recommend_source = None  # 當前推薦池對應的問題列表
+        self._recommend_order = []  # 打亂後的問題順序
+        self._recommend_cursor = 0
+        self._recommend_shown = 0  # 當前顯示的推薦標籤數
         self._update_recommend_buttons([])
 
         # ===================== 左側底部API Key配置區域 =====================
@@ -345,6 +427,8 @@ class PDFChatApp(ctk.CTk):
         )
         self.send_btn.pack(side="right", padx=(0, 15), pady=12)
         
+        self.update_idletasks()
+        self.deiconify()
         self._insert_message("系統", "歡迎使用本地 PDF 聊天應用程式！模型加載完成後即可上傳文檔使用。")
 
     # ===================== 保存API Key到.env文件 =====================
@@ -374,19 +458,19 @@ class PDFChatApp(ctk.CTk):
         def load_model_in_thread():
             self.is_model_loading = True
             try:
-                self.after(0, lambda: self.progress_label.configure(text="🔄 正在加載嵌入模型與重排模型...", text_color="#ffcc00"))
-                self.after(0, lambda: self.progress_bar.set(0.2))
+                self._post(lambda: self.progress_label.configure(text="🔄 正在加載嵌入模型與重排模型...", text_color="#ffcc00"))
+                self._post(lambda: self.progress_bar.set(0.2))
                 
                 self.vector_store = VectorStoreManager()
                 
-                self.after(0, lambda: self.progress_bar.set(1.0))
+                self._post(lambda: self.progress_bar.set(1.0))
                 self._update_progress(0, 0, "✅ 模型加載完成，就緒", 1.0, "#00ff9d", force=True)
                 
                 self.model_loaded = True
-                self.after(0, lambda: self.upload_btn.configure(state="normal"))
-                self.after(0, lambda: self.input_entry.configure(state="normal"))
-                self.after(0, lambda: self.send_btn.configure(state="normal"))
-                self.after(0, lambda: self.export_btn.configure(state="normal"))
+                self._post(lambda: self.upload_btn.configure(state="normal"))
+                self._post(lambda: self.input_entry.configure(state="normal"))
+                self._post(lambda: self.send_btn.configure(state="normal"))
+                self._post(lambda: self.export_btn.configure(state="normal"))
                 
                 # 提示用户是否已配置API Key
                 if not self.deepseek_api_key:
@@ -399,11 +483,11 @@ class PDFChatApp(ctk.CTk):
             finally:
                 self.is_model_loading = False
         
-        threading.Thread(target=load_model_in_thread, daemon=True).start()
+        self._start_background(load_model_in_thread)
 
     @throttle(100)
     def _update_progress(self, step, total_steps, step_name, progress_value, status_color="#00ff9d", force=False):
-        self.after(0, lambda: self._do_update_progress(step, total_steps, step_name, progress_value, status_color))
+        self._post(lambda: self._do_update_progress(step, total_steps, step_name, progress_value, status_color))
     
     def _do_update_progress(self, step, total_steps, step_name, progress_value, status_color):
         self.progress_label.configure(
@@ -414,7 +498,7 @@ class PDFChatApp(ctk.CTk):
 
     @throttle(100)
     def _update_text_chunk_progress(self, progress, step_name):
-        self.after(0, lambda: self._do_update_text_chunk_progress(progress, step_name))
+        self._post(lambda: self._do_update_text_chunk_progress(progress, step_name))
     
     def _do_update_text_chunk_progress(self, progress, step_name):
         total_progress = 0.2 + (progress * 0.3)
@@ -425,58 +509,107 @@ class PDFChatApp(ctk.CTk):
         self.progress_bar.set(total_progress)
 
     def _insert_message(self, sender, message):
-        self.after(0, lambda: self._do_insert_message(sender, message))
+        self._post(lambda: self._do_insert_message(sender, message))
     
     def _do_insert_message(self, sender, message):
-        bubble = MessageBubble(self.chat_scroll, sender, message)
-        bubble.pack(pady=8, padx=10, anchor=bubble.anchor)
+        # 先入隊，同一幀內的連續消息合併為一次佈局+滾動
+        self._msg_queue.append((sender, message))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            self.after(MESSAGE_FLUSH_MS, self._flush_messages)
+
+    def _flush_messages(self):
+        """批量創建排隊中的消息氣泡，只做一次 update_idletasks + 滾動到底部"""
+        self._flush_scheduled = False
+        if not self._msg_queue:
+            return
+        pending, self._msg_queue = self._msg_queue, []
+        for sender, message in pending:
+            bubble = MessageBubble(self.chat_scroll, sender, message)
+            bubble.pack(pady=8, padx=10, anchor=bubble.anchor)
+            self._bubbles.append(bubble)
         self.chat_scroll.update_idletasks()
         self.chat_scroll._parent_canvas.yview_moveto(1.0)
 
+    def _create_recommend_label(self):
+        """創建一個可復用的推薦問題標籤（點擊時提問標籤當前的文本）"""
+        btn_label = ctk.CTkLabel(
+            self.recommend_buttons_frame,
+            text="",
+            height=60,
+            font=("Microsoft YaHei", 13),
+            fg_color="#374151",
+            text_color="#ffffff",
+            corner_radius=6,
+            wraplength=200,
+            justify="left",
+            padx=14,
+            pady=5
+        )
+        btn_label.bind("<Button-1>", lambda e, lbl=btn_label: self._quick_ask(lbl.cget("text")))
+        return btn_label
+
+    def _next_recommend_questions(self, questions, k):
+        """按預先打亂的順序輪流取k個問題（一輪取完後重新打亂），刷新時無需重新抽樣"""
+        if self._recommend_source is not questions:
+            self._recommend_source = questions
+            self._recommend_order = list(questions)
+            random.shuffle(self._recommend_order)
+            self._recommend_cursor = 0
+        k = min(k, len(self._recommend_order))
+        if self._recommend_cursor + k > len(self._recommend_order):
+            random.shuffle(self._recommend_order)
+            self._recommend_cursor = 0
+        start = self._recommend_cursor
+        self._recommend_cursor += k
+        return self._recommend_order[start:start + k]
+
     def _update_recommend_buttons(self, questions):
+        # 標籤池復用：只隱藏/重新配置文本，不反覆銷毀重建控件
         for btn in self.recommend_buttons:
-            btn.destroy()
-        self.recommend_buttons.clear()
+            btn.pack_forget()
         
         if not questions:
-            empty_label = ctk.CTkLabel(
-                self.recommend_buttons_frame,
-                text="暫無推薦問題\n（請先上傳PDF文檔）",
-                font=("Microsoft YaHei", 11),
-                text_color="#9ca3af",
-                justify="center",
-                wraplength=250
-            )
-            empty_label.pack(pady=10)
-            self.recommend_buttons.append(empty_label)
+            if self.recommend_empty_label is None:
+                self.recommend_empty_label = ctk.CTkLabel(
+                    self.recommend_buttons_frame,
+                    text="暫無推薦問題\n（請先上傳PDF文檔）",
+                    font=("Microsoft YaHei", 11),
+                    text_color="#9ca3af",
+                    justify="center",
+                    wraplength=250
+                )
+            self.recommend_empty_label.pack(pady=10)
             self.refresh_btn.configure(state="disabled")
+            self._recommend_shown = 0
             return
         
+        if self.recommend_empty_label is not None:
+            self.recommend_empty_label.pack_forget()
         self.refresh_btn.configure(state="normal")
-        selected_questions = random.sample(questions, min(4, len(questions)))
-        
-        for q in selected_questions:
-            btn_label = ctk.CTkLabel(
-                self.recommend_buttons_frame,
-                text=q,
-                height=60,
-                font=("Microsoft YaHei", 13),
-                fg_color="#374151",
-                text_color="#ffffff",
-                corner_radius=6,
-                wraplength=200,
-                justify="left",
-                padx=14,
-                pady=5
-            )
+        selected_questions = self._next_recommend_questions(questions, 4)
+        
+        # 池不足時才新建標籤
+        while len(self.recommend_buttons) < len(selected_questions):
+            self.recommend_buttons.append(self._create_recommend_label())
+        for btn_label, q in zip(self.recommend_buttons, selected_questions):
+            btn_label.configure(text=q)
             btn_label.pack(pady=5, fill="x", padx=5)
-            self.recommend_buttons.append(btn_label)
-            btn_label.bind("<Button-1>", lambda e, q=q: self._quick_ask(q))
+        self._recommend_shown = len(selected_questions)
+
+    def _reshuffle_recommend_buttons(self):
+        """問題列表未變時刷新：只替換已顯示標籤的文本，不重新隱藏/排布"""
+        selected_questions = self._next_recommend_questions(self._recommend_source, self._recommend_shown)
+        for btn_label, q in zip(self.recommend_buttons, selected_questions):
+            btn_label.configure(text=q)
 
     def _refresh_recommend_questions(self):
         if not self.all_virtual_questions:
             return
-        self._update_recommend_buttons(self.all_virtual_questions)
+        if self.all_virtual_questions is self._recommend_source and self._recommend_shown:
+            self._reshuffle_recommend_buttons()
+        else:
+            self._update_recommend_buttons(self.all_virtual_questions)
 
     def _quick_ask(self, question):
         if self.is_processing or not self.model_loaded:
@@ -485,6 +618,26 @@ class PDFChatApp(ctk.CTk):
         self.input_entry.insert(0, question)
         self._send_question()
 
+    def _prefetch_file_hash(self, path):
+        """在後台線程開始計算文件Hash（按路徑+修改時間+大小緩存，文件未變時不重讀全文）"""
+        st = os.stat(path)
+        key = (path, st.st_mtime_ns, st.st_size)
+        future = self._hash_cache.get(key)
+        if future is None:
+            future = self._hash_executor.submit(self.file_cache.calculate_file_hash, path)
+            self._hash_cache[key] = future
+        return future
+
+    def _get_file_hash(self, path):
+        """取得文件Hash（等待後台計算完成）"""
+        future = self._prefetch_file_hash(path)
+        try:
+            return future.result()
+        except Exception:
+            # 計算失敗不緩存，下次重新計算
+            self._hash_cache = {k: f for k, f in self._hash_cache.items() if f is not future}
+            raise
+
     def _upload_pdf(self):
         if self.is_processing or not self.model_loaded or self.is_model_loading:
             return
@@ -497,6 +650,11 @@ class PDFChatApp(ctk.CTk):
             return
         
         self.current_file = file_path
+        # 選定文件後立即在後台計算Hash，與界面重置和處理線程啟動重疊
+        try:
+            self._prefetch_file_hash(file_path)
+        except OSError:
+            pass  # 文件不可訪問：處理線程中 _get_file_hash 會再次失敗並顯示錯誤
         self.is_processing = True
         self.upload_btn.configure(state="disabled")
         self.send_btn.configure(state="disabled")
@@ -514,29 +672,22 @@ class PDFChatApp(ctk.CTk):
             try:
                 # 1. 檢查緩存
                 self._update_progress(0, total_steps, "檢查文件緩存...", 0.05, "#ffcc00")
-                file_hash = self.file_cache.calculate_file_hash(file_path)
+                file_hash = self._get_file_hash(file_path)
                 file_name = os.path.basename(file_path)
+                if file_hash != self.current_file_hash:
+                    # 切換文檔時清空序號清洗緩存，避免跨文檔累積
+                    clean_question_serial_number.cache_clear()
+                    self.current_file_hash = file_hash
                 
                 if self.file_cache.is_cached(file_hash):
                     self._update_progress(1, total_steps, "緩存命中，正在加載...", 0.1, "#00ff9d")
-                    time.sleep(0.3)
                     
                     chunks, vector_store_path = self.file_cache.load_cache(file_hash)
                     
                     if chunks:
                         # 清洗序号
-                        all_questions = set()
-                        for chunk in chunks:
-                            virtual_qs = chunk.get("virtual_questions", []) or []
-                            for q in virtual_qs:
-                                q_stripped = q.strip() if q else ""
-                                if not q_stripped or len(q_stripped) <= 5:
-                                    continue
-                                cleaned_q = clean_question_serial_number(q_stripped)
-                                if cleaned_q and len(cleaned_q) > 5:
-                                    all_questions.add(cleaned_q)
-                        self.all_virtual_questions = list(all_questions)
-                        self.after(0, lambda: self._update_recommend_buttons(self.all_virtual_questions))
+                        self.all_virtual_questions = collect_virtual_questions(chunks)
+                        self._post(lambda: self._update_recommend_buttons(self.all_virtual_questions))
                         
                         self.vector_store.set_processed_chunks(chunks)
                         
@@ -572,36 +723,26 @@ class PDFChatApp(ctk.CTk):
                         return
                     else:
                         self._update_progress(1, total_steps, "緩存數據損壞，重新處理PDF...", 0.1, "#ffcc00")
-                        time.sleep(0.3)
                 
                 # 緩存未命中：全新處理流程
                 self._update_progress(1, total_steps, "PDF文件解析初始化", 0.1, "#ffcc00")
-                time.sleep(0.2)
                 
                 self._update_progress(2, total_steps, "文本分塊初始化", 0.2, "#ffcc00")
+                # 文本塊生成虛擬問題後即在後台向量化，與其餘塊的生成重疊
+                self.vector_store.begin_incremental_build()
                 chunks = self.pdf_processor.load_pdf_with_pages(
                     file_path,
-                    progress_callback=self._update_text_chunk_progress
+                    progress_callback=self._update_text_chunk_progress,
+                    chunk_callback=self.vector_store.add_chunks_incremental
                 )
                 if not chunks:
                     raise Exception("未提取到文本內容，請檢查PDF是否為掃描件")
                 
                 # 清洗序号
-                all_questions = set()
-                for chunk in chunks:
-                    virtual_qs = chunk.get("virtual_questions", []) or []
-                    for q in virtual_qs:
-                        q_stripped = q.strip() if q else ""
-                        if not q_stripped or len(q_stripped) <= 5:
-                            continue
-                        cleaned_q = clean_question_serial_number(q_stripped)
-                        if cleaned_q and len(cleaned_q) > 5:
-                            all_questions.add(cleaned_q)
-                self.all_virtual_questions = list(all_questions)
-                self.after(0, lambda: self._update_recommend_buttons(self.all_virtual_questions))
+                self.all_virtual_questions = collect_virtual_questions(chunks)
+                self._post(lambda: self._update_recommend_buttons(self.all_virtual_questions))
                 
                 self._update_progress(3, total_steps, "文檔增強（虛擬問題整合）", 0.6, "#ffcc00")
-                time.sleep(0.2)
                 
                 self._update_progress(4, total_steps, "構建向量索引中...", 0.8, "#ffcc00")
                 cache_index_path = os.path.join(self.file_cache.cache_dir, f"{file_hash}_index")
@@ -632,14 +773,16 @@ class PDFChatApp(ctk.CTk):
                 self._update_progress(0, total_steps, f"處理失敗：{str(e)}", 0, "#ff3300", force=True)
                 self._insert_message("系統", f"處理失敗：{str(e)}")
             finally:
+                # 解析失敗時 build_hierarchical_index 未被調用，需結束增量向量化線程（已完成時為空操作）
+                self.vector_store.cancel_incremental_build()
                 self.is_processing = False
-                self.after(100, lambda: self._update_progress(
+                self._post(lambda: self._update_progress(
                     0, 0, "✅ 就緒（等待上傳/提問）", 1.0, "#00ff9d", force=True
-                ))
-                self.after(0, lambda: self.upload_btn.configure(state="normal"))
-                self.after(0, lambda: self.send_btn.configure(state="normal"))
+                ), 100)
+                self._post(lambda: self.upload_btn.configure(state="normal"))
+                self._post(lambda: self.send_btn.configure(state="normal"))
         
-        threading.Thread(target=process_pdf, daemon=True).start()
+        self._start_background(process_pdf)
 
     def _send_question(self):
         question = self.input_entry.get().strip()
@@ -661,14 +804,27 @@ class PDFChatApp(ctk.CTk):
             total_steps = 5
             try:
                 self._update_progress(1, total_steps, "問題向量化中...", 0.15, "#ffcc00")
-                time.sleep(0.1)
+                
+                # 問答緩存：相同/近似問題直接返回已有回答，跳過檢索與LLM生成
+                file_hash = self.current_file_hash
+                query_embedding = None
+                cached_answer = None
+                if file_hash:
+                    cached_answer = self.answer_cache.get(file_hash, question)
+                    if cached_answer is None and self.answer_cache.can_match_similar(file_hash, question):
+                        query_embedding = self.vector_store.embeddings.embed_query(question)
+                        cached_answer = self.answer_cache.get_similar(file_hash, question, query_embedding)
+                if cached_answer is not None:
+                    self._insert_message("AI", cached_answer)
+                    self._update_progress(5, total_steps, "回答完成（緩存）", 1.0, "#00ff9d", force=True)
+                    return
                 
                 self._update_progress(2, total_steps, "向量檢索中...", 0.35, "#ffcc00")
                 
                 index_valid = (self.vector_store.global_db is not None) or (len(self.vector_store.hierarchical_index) > 0)
                 if not index_valid:
                     if self.current_file:
-                        file_hash = self.file_cache.calculate_file_hash(self.current_file)
+                        file_hash = self._get_file_hash(self.current_file)
                         cache_index_path = os.path.join(self.file_cache.cache_dir, f"{file_hash}_index")
                         if os.path.exists(cache_index_path):
                             load_success = self.vector_store.load_index_from_path(cache_index_path)
@@ -689,24 +845,34 @@ class PDFChatApp(ctk.CTk):
                     return
                 
                 self._update_progress(3, total_steps, "結果重排中...", 0.55, "#ffcc00")
-                time.sleep(0.1)
                 
                 self._update_progress(4, total_steps, "上下文增強中...", 0.75, "#ffcc00")
-                time.sleep(0.1)
                 
                 self._update_progress(5, total_steps, "AI生成回答中...", 0.95, "#ffcc00")
                 stream = self.rag_engine.stream_query(question, contexts)
                 
                 self._insert_message("AI", "")
                 full_answer = ""
+                answer_from_llm = False  # 僅緩存模型生成的回答（不緩存錯誤提示）
                 for chunk in stream:
+                    if self._closing:
+                        break  # 窗口已關閉，停止接收回答
                     if hasattr(chunk, 'choices') and chunk.choices[0].delta.content:
                         content = chunk.choices[0].delta.content
                         full_answer += content
-                        self.after(0, lambda: self._update_last_ai_bubble(full_answer))
+                        answer_from_llm = True
+                        self._update_last_ai_bubble(full_answer)
                     elif isinstance(chunk, str):
                         full_answer = chunk
-                        self.after(0, lambda: self._update_last_ai_bubble(full_answer))
+                        answer_from_llm = False
+                        self._update_last_ai_bubble(full_answer)
+                # 節流期間被略過的最後幾個token：強制刷新一次完整回答
+                self._update_last_ai_bubble(full_answer, force=True)
+                
+                if file_hash and answer_from_llm and full_answer:
+                    if query_embedding is None and not is_targeted_query(question):
+                        query_embedding = self.vector_store.embeddings.embed_query(question)
+                    self.answer_cache.put(file_hash, question, full_answer, query_embedding)
                 
                 self._update_progress(5, total_steps, "回答完成", 1.0, "#00ff9d", force=True)
                 
@@ -715,66 +881,83 @@ class PDFChatApp(ctk.CTk):
                 self._insert_message("AI", f"問答失敗：{str(e)}")
             finally:
                 self.is_processing = False
-                self.after(100, lambda: self._update_progress(
+                self._post(lambda: self._update_progress(
                     0, 0, "✅ 就緒（等待上傳/提問）", 1.0, "#00ff9d", force=True
-                ))
-                self.after(0, lambda: self.send_btn.configure(state="normal"))
-                self.after(0, lambda: self.upload_btn.configure(state="normal"))
+                ), 100)
+                self._post(lambda: self.send_btn.configure(state="normal"))
+                self._post(lambda: self.upload_btn.configure(state="normal"))
         
-        threading.Thread(target=stream_answer, daemon=True).start()
+        self._start_background(stream_answer)
 
-    def _update_last_ai_bubble(self, new_content):
-        children = self.chat_scroll.winfo_children()
-        if children:
-            last_bubble = children[-1]
-            if isinstance(last_bubble, MessageBubble) and last_bubble.sender == "AI":
+    @throttle(60)
+    def _update_last_ai_bubble(self, new_content, force=False):
+        # 只記錄最新回答；每幀最多排隊一次刷新，刷新時讀取最新值
+        self._latest_ai_answer = new_content
+        if not self._stream_update_pending:
+            self._stream_update_pending = True
+            self._post(self._do_update_last_ai_bubble, MESSAGE_FLUSH_MS)
+
+    def _do_update_last_ai_bubble(self):
+        self._stream_update_pending = False
+        # AI氣泡可能仍在消息隊列中，先落地再更新
+        self._flush_messages()
+        new_content = self._latest_ai_answer
+        if self._bubbles:
+            last_bubble = self._bubbles[-1]
+            if last_bubble.sender == "AI":
+                if last_bubble.message == new_content:
+                    return  # 事件循環積壓時，前一個事件已渲染最新内容
                 last_bubble.message = new_content
                 last_bubble.text_label.configure(text=new_content)
                 self.chat_scroll.update_idletasks()
                 self.chat_scroll._parent_canvas.yview_moveto(1.0)
 
     def _export_chat_history(self):
-        children = self.chat_scroll.winfo_children()
-        bubbles = [child for child in children if isinstance(child, MessageBubble)]
+        self._flush_messages()
+        bubbles = self._bubbles
         
         if not bubbles:
             self._insert_message("系統", "📭 暫無對話記錄可匯出")
             return
         
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        # 只取一次當前時間，文件名與頁首共用
+        now = datetime.now()
+        timestamp = now.strftime("%Y%m%d_%H%M%S")
         default_filename = f"PDF聊天記錄_{timestamp}.txt"
         
         file_path = filedialog.asksaveasfilename(
-            defaultextension=".txt",
-            filetypes=[("文本文件", "*.txt"), ("Markdown文件", "*.md"), ("所有文件", "*.*")],
+            defaultextension=_EXPORT_DEFAULT_EXTENSION,
+            filetypes=_EXPORT_FILETYPES,
             initialfile=default_filename,
             title="匯出對話記錄"
         )
         if not file_path:
             return
         
+        header_time = now.strftime("%Y-%m-%d %H:%M:%S")
+        doc_name = os.path.basename(self.current_file) if self.current_file else "無"
+        header = _EXPORT_HEADER_TEMPLATE.format(time=header_time, doc=doc_name)
+        # 主線程只讀取氣泡數據快照（Tk控件非線程安全），寫文件交給後台線程
+        rows = [(bubble.sender, bubble.message) for bubble in bubbles]
+        self._executor.submit(self._write_chat_export, file_path, header, rows)
+
+    def _write_chat_export(self, file_path, header, rows):
+        """
+        後台線程：寫入對話記錄文件，完成後在聊天區提示結果
+        :param file_path: 匯出文件路徑
+        :param header: 頁首文本
+        :param rows: [(發送者, 消息), ...]
+        """
         try:
-            lines = []
-            lines.append("=" * 50)
-            lines.append(f"匯出時間：{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
-            if self.current_file:
-                lines.append(f"關聯文檔：{os.path.basename(self.current_file)}")
-            else:
-                lines.append("關聯文檔：無")
-            lines.append("=" * 50)
-            lines.append("")
-            
-            for bubble in bubbles:
-                sender = bubble.sender
-                message = bubble.message.strip()
-                if message:
-                    lines.append(f"【{sender}】{message}")
-                    lines.append("")
-            
-            content = "\n".join(lines)
-            
-            with open(file_path, "w", encoding="utf-8") as f:
-                f.write(content)
+            # 逐行寫入緩衝文件，不在內存中拼接整份記錄（文本模式保留平台換行符）
+            with open(file_path, "w", encoding="utf-8", buffering=EXPORT_BUFFER_SIZE) as f:
+                f.write(header)
+                # 生成器交給 writelines 在C層逐條寫入，不逐行調用 write
+                f.writelines(
+                    f"\n【{sender}】{_strip_if_padded(message)}\n"
+                    for sender, message in rows
+                    if message and not message.isspace()
+                )
             
             self._insert_message("系統", f"✅ 對話已成功匯出到：{os.path.basename(file_path)}")
         except Exception as e: